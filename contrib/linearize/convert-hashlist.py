@@ -0,0 +1,33 @@
+#!/usr/bin/python
+#
+# convert-hashlist.py: Convert a hashlist between the text and binary formats.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function
+import os
+import sys
+import imp
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+
+if __name__ == '__main__':
+	if len(sys.argv) != 3:
+		print("Usage: convert-hashlist.py INPUT-HASHLIST OUTPUT-HASHLIST")
+		sys.exit(1)
+
+	text_input = linearize.is_text_hashlist(sys.argv[1])
+	blkindex = linearize.read_hashlist(sys.argv[1])
+	with open(sys.argv[2], "wb") as f:
+		if text_input:
+			f.write(blkindex.data)
+		else:
+			for height in range(len(blkindex)):
+				f.write(linearize.hash_to_str(blkindex[height]) + '\n')
+
+	print("Wrote %i hashes in %s format" % (len(blkindex), 'binary' if text_input else 'text'))
+
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+#
+# linearize-addrindex.py: Index the outputs paying to each address in linearized block data into sqlite.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import time
+import sqlite3
+import multiprocessing
+from collections import deque
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+reader = imp.load_source('linearize_reader',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-reader.py'))
+base58 = imp.load_source('base58',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'testgen', 'base58.py'))
+
+MAINNET_MAGIC = 'f9beb4d9'.decode('hex')
+# Address version bytes (pubkey hash, script hash)
+MAINNET_VERSIONS = ('\x00', '\x05')
+TESTNET_VERSIONS = ('\x6f', '\xc4')
+# Bytes of block data handed to a parse worker at a time
+JOB_BYTES = 8 * 1000 * 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outputs (
+	address TEXT NOT NULL,
+	height INTEGER NOT NULL,
+	txid TEXT NOT NULL,
+	vout INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+	key TEXT PRIMARY KEY,
+	value TEXT NOT NULL
+);
+'''
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS outputs_address ON outputs (address);
+'''
+
+def script_address(script, versions):
+	'''Base58 address paid to by a P2PKH or P2SH output script, or None'''
+	(kind, hash) = reader.script_type(script)
+	if kind == reader.P2PKH:
+		return base58.b58encode_chk(versions[0] + hash)
+	if kind == reader.P2SH:
+		return base58.b58encode_chk(versions[1] + hash)
+	return None
+
+parse_files = None
+
+def parse_blocks_job(job):
+	'''Process pool entry point: (address, height, txid, vout) rows for the
+	   outputs to addresses in blocks at (file name, header offset, size,
+	   height), in order'''
+	global parse_files
+	(blocks, versions) = job
+	if parse_files is None:
+		parse_files = reader.MappedFiles()
+	rows = []
+	for (fname, offset, size, height) in blocks:
+		block = reader.Block(parse_files.get(fname), offset, size, height)
+		for tx in block.txs():
+			txid = None
+			for (n, txout) in enumerate(tx.outputs()):
+				address = script_address(txout.script, versions)
+				if address is None:
+					continue
+				if txid is None:
+					txid = linearize.hash_to_str(tx.txid)
+				rows.append((address, height, txid, n))
+	return rows
+
+class AddressIndex:
+	'''The sqlite database, with the height and hash of the last block indexed
+	   kept in the state table and updated in the same transaction as the rows'''
+	def __init__(self, fname):
+		self.db = sqlite3.connect(fname)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.executescript(SCHEMA)
+		state = dict(self.db.execute('SELECT key, value FROM state'))
+		self.height = int(state.get('height', -1))
+		self.tip = state.get('tip')
+
+	def hasIndexes(self):
+		return self.db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = 'outputs_address'").fetchone()[0] > 0
+
+	def append(self, rows, height, tip):
+		'''Insert the rows of the blocks up to height, whose hash is tip, and commit'''
+		with self.db:
+			self.db.executemany('INSERT INTO outputs (address, height, txid, vout) VALUES (?, ?, ?, ?)', rows)
+			self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('height', ?)", (str(height),))
+			self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('tip', ?)", (tip,))
+		self.height = height
+		self.tip = tip
+
+	def createIndexes(self):
+		self.db.executescript(INDEXES)
+
+	def history(self, address):
+		'''(height, txid, vout) of the outputs paying to address'''
+		return self.db.execute('SELECT height, txid, vout FROM outputs WHERE address = ? ORDER BY height, txid, vout',
+				(address,)).fetchall()
+
+	def close(self):
+		self.db.close()
+
+def update_index(settings, index):
+	'''Index the blocks after index.height, parsing in a pool of processes
+	   up to two jobs per process ahead of the inserts, which are done here in
+	   height order. Returns the number of blocks and rows added.'''
+	fnames = linearize.output_files(settings)
+	versions = MAINNET_VERSIONS if settings['netmagic'] == MAINNET_MAGIC else TESTNET_VERSIONS
+	workers = settings['addrindex_workers']
+	pool = multiprocessing.Pool(workers)
+	pending = deque()
+	blocks = 0
+	rows = 0
+	lastReport = time.time()
+	jobs = reader.block_batches(fnames, settings['netmagic'], index.height + 1, JOB_BYTES, index.tip)
+	while True:
+		job = next(jobs, None)
+		if len(pending) >= 2 * workers or (job is None and pending):
+			(batch, tip, result) = pending.popleft()
+			result = result.get()
+			index.append(result, batch[-1][3], tip)
+			blocks += len(batch)
+			rows += len(result)
+			now = time.time()
+			if now - lastReport >= 10:
+				print("Height %i: %i outputs indexed" % (index.height, rows))
+				lastReport = now
+		if job is not None:
+			(batch, tip) = job
+			pending.append((batch, tip, pool.apply_async(parse_blocks_job, ((batch, versions),))))
+		elif not pending:
+			break
+	pool.close()
+	pool.join()
+	return (blocks, rows)
+
+if __name__ == '__main__':
+	if len(sys.argv) not in (2, 3):
+		print("Usage: linearize-addrindex.py CONFIG-FILE [ADDRESS]")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'addrindex' not in settings:
+		settings['addrindex'] = 'addrindex.sqlite'
+	if 'addrindex_workers' not in settings:
+		settings['addrindex_workers'] = multiprocessing.cpu_count()
+	settings['addrindex_workers'] = int(settings['addrindex_workers'])
+
+	index = AddressIndex(settings['addrindex'])
+	if len(sys.argv) == 3:
+		for (height, txid, vout) in index.history(sys.argv[2]):
+			print("%i %s:%i" % (height, txid, vout))
+		index.close()
+		sys.exit(0)
+
+	if not linearize.output_files(settings):
+		print("No linearized output found")
+		sys.exit(1)
+	start = time.time()
+	try:
+		(blocks, rows) = update_index(settings, index)
+	except ValueError as e:
+		print("%s; remove %s to index from scratch" % (e, settings['addrindex']), file=sys.stderr)
+		sys.exit(1)
+	elapsed = max(time.time() - start, 1e-9)
+	print("Indexed %i blocks, %i outputs in %.1f s (%.0f blocks/s)" % (blocks, rows, elapsed, blocks / elapsed))
+	if not index.hasIndexes():
+		# created once the bulk of the rows is in, rather than updated on every insert
+		indexStart = time.time()
+		index.createIndexes()
+		print("Created address index in %.1f s" % (time.time() - indexStart))
+	index.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# linearize-bench.py: Measure BlockDataCopier throughput on a blocks directory.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import time
+import Queue
+import shutil
+import tempfile
+import resource
+import multiprocessing
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+
+def bench_copier(settings, overrides, result_queue):
+	'''Run one copier pass in a child process, so that each mode gets its own peak RSS'''
+	settings = dict(settings)
+	settings.update(overrides)
+	blkindex = linearize.get_block_hashes(settings)
+	blkmap = linearize.mkblockmap(blkindex)
+
+	copier = linearize.BlockDataCopier(settings, blkindex, blkmap)
+	start = time.time()
+	copier.run()
+	elapsed = time.time() - start
+
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	result_queue.put((copier.blkCountOut, elapsed, peak_rss))
+
+def load_legacy_hashlist(fname):
+	'''The original hashlist representation: hex strings in a list and a dict'''
+	blkindex = []
+	with open(fname, "r") as f:
+		for line in f:
+			blkindex.append(line.rstrip())
+	blkmap = {}
+	for height,hash in enumerate(blkindex):
+		blkmap[hash] = height
+	return blkmap
+
+def current_rss():
+	'''Resident set size in kB, or peak RSS where /proc is not available'''
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * resource.getpagesize() // 1024
+	except IOError:
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_hashlist(fname, legacy, result_queue):
+	'''Load a hashlist and look up every hash in it, as the copier does for each header'''
+	base_rss = current_rss()
+	start = time.time()
+	if legacy:
+		blkmap = load_legacy_hashlist(fname)
+	else:
+		blkmap = linearize.mkblockmap(linearize.read_hashlist(fname))
+	load_time = time.time() - start
+	load_rss = current_rss() - base_rss
+
+	hashes = linearize.read_hashlist(fname)
+	hashes = [hashes[height] for height in range(len(hashes))]
+	start = time.time()
+	if legacy:
+		for hash in hashes:
+			blkmap[linearize.wordreverse(linearize.bufreverse(hash)).encode('hex')]
+	else:
+		for hash in hashes:
+			blkmap[hash]
+	lookup_time = time.time() - start
+	result_queue.put((len(hashes), load_time, load_rss, lookup_time))
+
+def child_result(p, result_queue):
+	'''Wait for the result of child process p, exiting if it died without one'''
+	while True:
+		try:
+			return result_queue.get(timeout=1)
+		except Queue.Empty:
+			if not p.is_alive() and result_queue.empty():
+				print("Benchmark process failed (exit code %s)" % p.exitcode, file=sys.stderr)
+				sys.exit(1)
+
+def run_hashlist_bench(name, fname, legacy):
+	result_queue = multiprocessing.Queue()
+	p = multiprocessing.Process(target=bench_hashlist, args=(fname, legacy, result_queue))
+	p.start()
+	result = child_result(p, result_queue)
+	p.join()
+	return (name,) + result
+
+def print_hashlist_results(results):
+	print("%-24s %10s %10s %12s %12s" % ('hashlist', 'hashes', 'load s', 'load RSS kB', 'lookups/s'))
+	for (name, count, load_time, load_rss, lookup_time) in results:
+		print("%-24s %10i %10.2f %12i %12.0f" %
+			(name, count, load_time, load_rss, count / max(lookup_time, 1e-9)))
+
+def run_bench(settings, name, overrides):
+	result_queue = multiprocessing.Queue()
+	p = multiprocessing.Process(target=bench_copier, args=(settings, overrides, result_queue))
+	p.start()
+	(blocks, elapsed, peak_rss) = child_result(p, result_queue)
+	p.join()
+	return (name, blocks, elapsed, peak_rss)
+
+def print_results(results):
+	print("%-24s %10s %10s %12s %12s" % ('mode', 'blocks', 'seconds', 'blocks/s', 'peak RSS kB'))
+	for (name, blocks, elapsed, peak_rss) in results:
+		print("%-24s %10i %10.2f %12.1f %12i" %
+			(name, blocks, elapsed, blocks / max(elapsed, 1e-9), peak_rss))
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: linearize-bench.py CONFIG-FILE")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'bench_dir' in settings:
+		bench_dir = settings['bench_dir']
+		cleanup = False
+		if not os.path.isdir(bench_dir):
+			os.makedirs(bench_dir)
+	else:
+		bench_dir = tempfile.mkdtemp(prefix='linearize-bench')
+		cleanup = True
+
+	# Always write to a scratch bootstrap file, never to the configured output
+	settings.pop('output', None)
+	settings['output_file'] = os.path.join(bench_dir, 'bootstrap.dat')
+
+	modes = [
+		('read', { 'input_mmap' : 0 }),
+		('mmap', { 'input_mmap' : 1 }),
+		('range_copy', { 'input_mmap' : 0, 'range_copy' : 1 }),
+	]
+	# Out-of-order cache sweep, in the default streaming mode
+	if 'bench_cache_sizes' in settings:
+		for size in settings['bench_cache_sizes'].split(','):
+			modes.append(('cache %s' % size.strip(), { 'out_of_order_cache_sz' : int(size) }))
+
+	results = []
+	hashlist_results = []
+	try:
+		for (name, overrides) in modes:
+			results.append(run_bench(settings, name, overrides))
+			if os.path.exists(settings['output_file']):
+				os.remove(settings['output_file'])
+
+		# Compare hashlist representations, with the hashlist in both formats
+		blkindex = linearize.read_hashlist(settings['hashlist'])
+		text_hashlist = os.path.join(bench_dir, 'hashlist.txt')
+		binary_hashlist = os.path.join(bench_dir, 'hashlist.bin')
+		with open(text_hashlist, "w") as f:
+			for height in range(len(blkindex)):
+				f.write(linearize.hash_to_str(blkindex[height]) + '\n')
+		with open(binary_hashlist, "wb") as f:
+			f.write(blkindex.data)
+		blkindex = None
+		hashlist_results.append(run_hashlist_bench('text, hex dict', text_hashlist, True))
+		hashlist_results.append(run_hashlist_bench('text, compact map', text_hashlist, False))
+		hashlist_results.append(run_hashlist_bench('binary, compact map', binary_hashlist, False))
+	finally:
+		if cleanup:
+			shutil.rmtree(bench_dir)
+
+	print_results(results)
+	print_hashlist_results(hashlist_results)
+
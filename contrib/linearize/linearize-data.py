@@ -18,7 +18,24 @@ import sys
 import hashlib
 import datetime
 import time
-from collections import namedtuple
+import imp
+import threading
+import mmap
+import array
+import bisect
+import binascii
+import itertools
+import heapq
+import tempfile
+import multiprocessing
+import zlib
+import socket
+from collections import namedtuple, deque
+
+try:
+	import lzma
+except ImportError:
+	lzma = None
 
 settings = {}
 
@@ -68,31 +85,1165 @@ def get_blk_dt(blk_hdr):
 	dt_ym = datetime.datetime(dt.year, dt.month, 1)
 	return (dt_ym, nTime)
 
+def hash_to_str(hash):
+	'''Hex form, as used by RPC and text hashlists, of a raw block hash'''
+	return hash[::-1].encode('hex')
+
+def str_to_hash(hash_str):
+	return hash_str.decode('hex')[::-1]
+
+class BlockHashList:
+	'''Block hashes by height, stored as consecutive 32-byte records of raw
+	   hashes (the byte order calc_hdr_hash returns)'''
+	def __init__(self, data):
+		self.data = data
+
+	def __len__(self):
+		return len(self.data) // 32
+
+	def __getitem__(self, height):
+		if height < 0:
+			height += len(self)
+		if height < 0 or height >= len(self):
+			raise IndexError(height)
+		return self.data[height * 32:(height + 1) * 32]
+
+def is_text_hashlist(fname):
+	with open(fname, "rb") as f:
+		head = f.read(65)
+	return len(head) >= 64 and re.match('^[0-9a-fA-F]{64}\r?\n?$', head) is not None
+
+def read_hashlist(fname):
+	'''Load a hashlist in either the text format written by linearize-hashes.py
+	   (one hex hash per line) or the binary format (32-byte raw hashes)'''
+	if is_text_hashlist(fname):
+		with open(fname, "r") as f:
+			lines = f.read().split()
+		# Reversing the whole decoded string puts every hash in raw byte
+		# order, so decode the lines last to first
+		lines.reverse()
+		return BlockHashList(binascii.unhexlify(''.join(lines))[::-1])
+	with open(fname, "rb") as f:
+		data = f.read()
+	if len(data) % 32:
+		raise ValueError("%s is neither a text nor a binary hashlist" % fname)
+	return BlockHashList(data)
+
 def get_block_hashes(settings):
-	blkindex = []
-	f = open(settings['hashlist'], "r")
-	for line in f:
-		line = line.rstrip()
-		blkindex.append(line)
+	blkindex = read_hashlist(settings['hashlist'])
 
 	print("Read " + str(len(blkindex)) + " hashes")
 
 	return blkindex
 
+class BlockHashMap:
+	'''Compact raw hash -> height lookup for a BlockHashList.
+
+	   Hashes are kept sorted in a single string with a parallel array of
+	   heights, about 36 bytes per block. A table indexed by the first two
+	   bytes of a hash narrows each binary search to a small bucket.'''
+	def __init__(self, blkindex):
+		data = blkindex.data
+		entries = sorted([data[height * 32:(height + 1) * 32] + struct.pack('<I', height)
+				for height in range(len(blkindex))])
+		self.keys = ''.join([entry[:32] for entry in entries])
+		self.heights = array.array('I', ''.join([entry[32:] for entry in entries]))
+		self.buckets = array.array('I', [bisect.bisect_left(entries, struct.pack('>H', bucket))
+				for bucket in range(65536)] + [len(entries)])
+
+	def __len__(self):
+		return len(self.heights)
+
+	def get(self, hash, default=None):
+		bucket = struct.unpack_from('>H', hash)[0]
+		lo = self.buckets[bucket]
+		hi = self.buckets[bucket + 1]
+		while lo < hi:
+			mid = (lo + hi) // 2
+			key = self.keys[mid * 32:(mid + 1) * 32]
+			if key < hash:
+				lo = mid + 1
+			elif key > hash:
+				hi = mid
+			else:
+				return self.heights[mid]
+		return default
+
+	def __contains__(self, hash):
+		return self.get(hash) is not None
+
+	def __getitem__(self, hash):
+		height = self.get(hash)
+		if height is None:
+			raise KeyError(hash_to_str(hash))
+		return height
+
 def mkblockmap(blkindex):
-	blkmap = {}
-	for height,hash in enumerate(blkindex):
-		blkmap[hash] = height
-	return blkmap
+	return BlockHashMap(blkindex)
+
+class RPCHashStream:
+	'''Block hashes fetched from bitcoind by a background thread, in batches
+	   of getblockhash calls, and readable by height while the fetch is still
+	   running. Reading a height that has not arrived yet waits for it.
+	   A failed fetch ends the stream early and leaves its message in error.'''
+	def __init__(self, settings, max_blocks_per_call=10000):
+		linearize_hashes = imp.load_source('linearize_hashes',
+			os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-hashes.py'))
+		self.rpc = linearize_hashes.BitcoinRPC(settings['host'], settings['port'],
+				settings['rpcuser'], settings['rpcpassword'])
+		self.maxHeight = settings['max_height']
+		self.batchSize = max_blocks_per_call
+		self.batches = [] # strings of 32-byte raw hashes, batchSize hashes each
+		self.count = 0
+		self.done = False
+		self.error = None
+		self.cond = threading.Condition()
+		self.thread = threading.Thread(target=self.fetch)
+		self.thread.daemon = True
+
+	def start(self):
+		if self.maxHeight < 0:
+			reply = self.rpc.execute(self.rpc.build_request(0, 'getblockcount', None))
+			if self.rpc.response_is_error(reply):
+				self.error = 'JSON-RPC: getblockcount failed: %s' % reply['error']
+				self.done = True
+				return
+			self.maxHeight = reply['result']
+		self.thread.start()
+
+	def fetch(self):
+		height = 0
+		try:
+			while height <= self.maxHeight:
+				num_blocks = min(self.maxHeight + 1 - height, self.batchSize)
+				batch = []
+				for x in range(num_blocks):
+					batch.append(self.rpc.build_request(x, 'getblockhash', [height + x]))
+
+				hashes = []
+				for x,resp_obj in enumerate(self.rpc.execute(batch)):
+					if self.rpc.response_is_error(resp_obj):
+						if resp_obj['error'].get('code') != -8: # not just past the tip
+							self.error = 'JSON-RPC: error at height %i: %s' % (height + x, resp_obj['error'])
+						break
+					assert(resp_obj['id'] == x) # assume replies are in-sequence
+					hashes.append(str_to_hash(resp_obj['result']))
+
+				with self.cond:
+					self.batches.append(''.join(hashes))
+					self.count += len(hashes)
+					self.cond.notify_all()
+				if len(hashes) < num_blocks:
+					break
+				height += num_blocks
+		except Exception as e:
+			self.error = 'JSON-RPC: fetching block hashes failed: %s' % e
+		finally:
+			with self.cond:
+				self.done = True
+				self.cond.notify_all()
+
+	def available(self, height=None):
+		'''Return the number of hashes fetched so far, after waiting until it
+		   exceeds height or the fetch has finished'''
+		with self.cond:
+			while height is not None and self.count <= height and not self.done:
+				self.cond.wait(1.0)
+			return self.count
+
+	def __len__(self):
+		with self.cond:
+			if self.done:
+				return self.count
+			return self.maxHeight + 1
+
+	def __getitem__(self, height):
+		if height < 0 or height >= self.available(height):
+			raise IndexError(height)
+		(batch, index) = divmod(height, self.batchSize)
+		return self.batches[batch][index * 32:(index + 1) * 32]
 
 # Block header and extent on disk
 BlockExtent = namedtuple('BlockExtent', ['fn', 'offset', 'inhdr', 'blkhdr', 'size'])
 
+# buffer(obj, offset, size) slices an mmap or string without copying
+view_slice = buffer
+
+# Largest single read of a range copy
+COPY_CHUNK = 16 * 1024 * 1024
+
+def copy_range(inF, outF, offset, count):
+	'''Append count bytes at offset in inF to outF, in buffered reads of up
+	   to COPY_CHUNK bytes'''
+	inF.seek(offset)
+	while count > 0:
+		data = inF.read(min(count, COPY_CHUNK))
+		if not data:
+			raise IOError("Unexpected end of input file")
+		outF.write(data)
+		count -= len(data)
+
+class MappedBlockFile:
+	'''Read-only file-like wrapper around a memory-mapped input file.
+	   read() returns views into the mapping instead of copies.'''
+	def __init__(self, fname):
+		with open(fname, "rb") as f:
+			self.size = os.fstat(f.fileno()).st_size
+			if self.size:
+				self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				self.map = None
+		self.pos = 0
+
+	def read(self, n):
+		n = min(n, self.size - self.pos)
+		if n <= 0:
+			return b''
+		data = view_slice(self.map, self.pos, n)
+		self.pos += n
+		return data
+
+	def seek(self, offset, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			offset += self.pos
+		elif whence == os.SEEK_END:
+			offset += self.size
+		self.pos = offset
+
+	def tell(self):
+		return self.pos
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+
+def scan_block_file(fname, netmagic, start=0, headers=False):
+	'''Walk the block records in one input file, starting at offset start.
+	   Returns (blocks, end), where blocks is a list of (hash, offset, size)
+	   tuples in file order, with the 80-byte header appended to each tuple
+	   if headers is set, and end is the offset at which scanning stopped.'''
+	blocks = []
+	pos = start
+	with open(fname, "rb") as f:
+		fsize = os.fstat(f.fileno()).st_size
+		f.seek(start)
+		while True:
+			inhdr = f.read(8)
+			if len(inhdr) < 8 or inhdr[0] == "\0":
+				break
+			if inhdr[:4] != netmagic:
+				print("Invalid magic in %s at offset %i" % (fname, pos))
+				break
+			inLen = struct.unpack("<I", inhdr[4:])[0] - 80 # length without header
+			if pos + 88 + inLen > fsize:
+				break # partially written record
+			blk_hdr = f.read(80)
+			if headers:
+				blocks.append((calc_hdr_hash(blk_hdr), pos + 88, inLen, blk_hdr))
+			else:
+				blocks.append((calc_hdr_hash(blk_hdr), pos + 88, inLen))
+			f.seek(inLen, os.SEEK_CUR)
+			pos += 88 + inLen
+	return (blocks, pos)
+
+def scan_block_file_job(job):
+	'''Process pool entry point for scan_block_file'''
+	(fname, netmagic, start) = job
+	(blocks, end) = scan_block_file(fname, netmagic, start)
+	return (fname, start, blocks, end)
+
+def output_files(settings):
+	'''Paths of the linearized output: output_file, or the blkNNNNN.dat files
+	   of the output directory'''
+	if 'output_file' in settings:
+		return [settings['output_file']]
+	fnames = []
+	while os.path.exists(os.path.join(settings['output'], "blk%05d.dat" % len(fnames))):
+		fnames.append(os.path.join(settings['output'], "blk%05d.dat" % len(fnames)))
+	return fnames
+
+def scan_block_dir_job(jobs):
+	'''Process pool entry point: scan_block_file_job for each file of one
+	   input directory in turn, so that every disk has a single reader'''
+	return [scan_block_file_job(job) for job in jobs]
+
+def input_dir_files(settings):
+	'''Paths of the blkNNNNN.dat files, listed per input directory'''
+	dirs = []
+	for dirname in settings['input_dirs']:
+		fnames = []
+		while os.path.exists("%s/blk%05d.dat" % (dirname, len(fnames))):
+			fnames.append("%s/blk%05d.dat" % (dirname, len(fnames)))
+		dirs.append(fnames)
+	return dirs
+
+def scan_block_headers_job(job):
+	'''Process pool entry point for best-chain derivation: returns the
+	   hash, previous block hash and nBits of every block in one input file,
+	   packed as consecutive 68-byte records'''
+	(fname, netmagic) = job
+	(blocks, end) = scan_block_file(fname, netmagic, headers=True)
+	return ''.join([hash + blk_hdr[4:36] + blk_hdr[72:76] for (hash, offset, size, blk_hdr) in blocks])
+
+def bits_to_work(bits):
+	'''Expected number of hashes for a block with compact target bits'''
+	exponent = bits >> 24
+	mantissa = bits & 0x007fffff
+	if bits & 0x00800000 or mantissa == 0:
+		return 0
+	if exponent <= 3:
+		target = mantissa >> (8 * (3 - exponent))
+	else:
+		target = mantissa << (8 * (exponent - 3))
+	if target == 0 or target >> 256:
+		return 0
+	return (1 << 256) // (target + 1)
+
+# Cumulative chain work, as high and low 64-bit halves
+CHAINWORK = struct.Struct('<QQ')
+
+def unpack_work(work, i):
+	(hi, lo) = CHAINWORK.unpack_from(work, i * 16)
+	return (hi << 64) | lo
+
+def derive_best_chain(fnames, netmagic, workers):
+	'''Find the chain with the most work among the block headers in the input
+	   files, without a hashlist. Headers are linked to their parents through
+	   a BlockHashMap, and heights and cumulative work are kept in flat arrays
+	   (work as 128-bit integers), about 160 bytes per header in total.
+	   Returns (blkindex, chainwork) for the best chain.'''
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+		results = pool.imap(scan_block_headers_job, [(fname, netmagic) for fname in fnames])
+	else:
+		pool = None
+		results = itertools.imap(scan_block_headers_job, [(fname, netmagic) for fname in fnames])
+	records = ''.join(results)
+	if pool:
+		pool.close()
+		pool.join()
+	count = len(records) // 68
+	print("Read %i block headers from %i input files" % (count, len(fnames)))
+
+	hashes = BlockHashList(''.join([records[i * 68:i * 68 + 32] for i in range(count)]))
+	hashmap = BlockHashMap(hashes)
+	nullHash = '\0' * 32
+	parent = array.array('i', [-1]) * count
+	for i in range(count):
+		prev = records[i * 68 + 32:i * 68 + 64]
+		if prev != nullHash:
+			parent[i] = hashmap.get(prev, -2) # -2: parent not in the input
+
+	# Walk up from each header to the first one already visited, then assign
+	# heights and work on the way back down. Headers whose ancestry does not
+	# reach a genesis block (a null previous hash) keep height -1.
+	height = array.array('i', [-1]) * count
+	work = bytearray(16 * count)
+	done = bytearray(count)
+	for i in range(count):
+		path = []
+		j = i
+		while j >= 0 and not done[j]:
+			path.append(j)
+			done[j] = 1
+			j = parent[j]
+		if j >= 0:
+			(baseHeight, baseWork) = (height[j], unpack_work(work, j))
+		else:
+			(baseHeight, baseWork) = (-1, 0)
+		if j == -2 or (j >= 0 and baseHeight < 0):
+			continue # orphaned: leave heights at -1
+		for j in reversed(path):
+			baseHeight += 1
+			baseWork += bits_to_work(struct.unpack_from('<I', records, j * 68 + 64)[0])
+			if baseWork >> 128:
+				raise ValueError("chain work does not fit in 128 bits")
+			height[j] = baseHeight
+			CHAINWORK.pack_into(work, j * 16, baseWork >> 64, baseWork & 0xffffffffffffffffL)
+
+	# Most work wins; among equal work, the header seen first in the input
+	tip = None
+	bestWork = -1
+	for i in range(count):
+		if height[i] >= 0 and unpack_work(work, i) > bestWork:
+			(tip, bestWork) = (i, unpack_work(work, i))
+	if tip is None:
+		return (BlockHashList(''), 0)
+
+	chain = []
+	while tip >= 0:
+		chain.append(records[tip * 68:tip * 68 + 32])
+		tip = parent[tip]
+	chain.reverse()
+	return (BlockHashList(''.join(chain)), bestWork)
+
+def get_best_chain_hashes(settings):
+	fnames = list(itertools.chain(*input_dir_files(settings)))
+	(blkindex, chainwork) = derive_best_chain(fnames, settings['netmagic'], settings['scan_workers'])
+	if len(blkindex):
+		print("Best chain from block headers: height %i, tip %s, chainwork %064x" %
+				(len(blkindex) - 1, hash_to_str(blkindex[-1]), chainwork))
+	return blkindex
+
+def write_shard_job(job):
+	'''Process pool entry point for the sharded writer: write one output file
+	   from (input file name, offset, size) block extents in height order,
+	   starting at offset start. Records adjacent in the input are read
+	   together, up to COPY_CHUNK bytes at a time. With digestChunkSize set,
+	   the whole file is also digested as for the manifest.
+	   Returns (bytes written, highest block timestamp, digest result or None).'''
+	(fname, start, extents, sync, digestChunkSize) = job
+	digest = None
+	if digestChunkSize:
+		digest = OutputDigest(digestChunkSize)
+		if start:
+			digest.updateFromFile(fname, start)
+	if start:
+		outF = open(fname, "r+b")
+		outF.seek(start)
+	else:
+		outF = open(fname, "wb")
+	inFname = None
+	inF = None
+	written = 0
+	highTS = 0
+	i = 0
+	while i < len(extents):
+		(inName, offset, size) = extents[i]
+		runStart = offset - 88
+		runEnd = offset + size
+		j = i + 1
+		while (j < len(extents) and extents[j][0] == inName and extents[j][1] - 88 == runEnd and
+				extents[j][1] + extents[j][2] - runStart <= COPY_CHUNK):
+			runEnd = extents[j][1] + extents[j][2]
+			j += 1
+		if inName != inFname:
+			if inF:
+				inF.close()
+			inF = open(inName, "rb")
+			inFname = inName
+		inF.seek(runStart)
+		data = inF.read(runEnd - runStart)
+		if len(data) != runEnd - runStart:
+			raise IOError("Unexpected end of input file %s" % inName)
+		for (inName, offset, size) in extents[i:j]:
+			# nTime is at offset 68 of the header, which starts 80 bytes before the body
+			highTS = max(highTS, struct.unpack_from('<I', data, offset - runStart - 12)[0])
+		outF.write(data)
+		if digest:
+			digest.update(data)
+		written += len(data)
+		i = j
+	if inF:
+		inF.close()
+	if sync:
+		outF.flush()
+		os.fsync(outF.fileno())
+	outF.close()
+	return (written, highTS, digest.result() if digest else None)
+
+class ExtentIndex:
+	'''Sidecar index of the block records found in each input file.
+
+	   Entries are keyed by input file path and remember the file's size and
+	   mtime when it was scanned. Block files are append-only, so a file that
+	   changed but did not shrink only needs scanning from where the previous
+	   scan stopped.'''
+	MAGIC = 'LXI2'
+	FILE_HDR = struct.Struct('<QdQI') # size, mtime, end, block count
+	RECORD = struct.Struct('<32sII') # hash, offset, size
+
+	def __init__(self, fname):
+		self.fname = fname
+		self.files = {}
+		self.dirty = False
+		if fname is None:
+			return # in-memory only
+		try:
+			f = open(fname, "rb")
+		except IOError:
+			return
+		with f:
+			if f.read(4) != self.MAGIC:
+				print("Ignoring extent index %s with unknown format" % fname)
+				return
+			while True:
+				lenbuf = f.read(2)
+				if not lenbuf:
+					break
+				path = f.read(struct.unpack('<H', lenbuf)[0])
+				(size, mtime, end, count) = self.FILE_HDR.unpack(f.read(self.FILE_HDR.size))
+				data = f.read(count * self.RECORD.size)
+				blocks = []
+				for i in range(count):
+					(hash, offset, blksize) = self.RECORD.unpack_from(data, i * self.RECORD.size)
+					blocks.append((hash, offset, blksize))
+				self.files[path] = (size, mtime, end, blocks)
+
+	def resumeOffset(self, fname, st):
+		'''Return the offset fname must be scanned from given its current stat
+		   result, or None if the index is up to date for it'''
+		entry = self.files.get(fname)
+		if entry is None:
+			return 0
+		(size, mtime, end, blocks) = entry
+		if size == st.st_size and mtime == st.st_mtime:
+			return None
+		if st.st_size >= size:
+			return end
+		return 0
+
+	def update(self, fname, st, start, newblocks, end):
+		'''Record the result of scanning fname from offset start'''
+		if start:
+			blocks = self.files[fname][3] + newblocks
+		else:
+			blocks = newblocks
+		self.files[fname] = (st.st_size, st.st_mtime, end, blocks)
+		self.dirty = True
+
+	def blocks(self, fname):
+		return self.files[fname][3]
+
+	def save(self):
+		if self.fname is None or not self.dirty:
+			return
+		tmpname = self.fname + '.tmp'
+		with open(tmpname, "wb") as f:
+			f.write(self.MAGIC)
+			for path in sorted(self.files):
+				(size, mtime, end, blocks) = self.files[path]
+				f.write(struct.pack('<H', len(path)) + path)
+				f.write(self.FILE_HDR.pack(size, mtime, end, len(blocks)))
+				f.write(''.join([self.RECORD.pack(hash, offset, blksize)
+						for (hash, offset, blksize) in blocks]))
+		os.rename(tmpname, self.fname)
+		self.dirty = False
+
+class OutOfOrderCache:
+	'''Holds the data of blocks read ahead of the height being written.
+
+	   When more than maxSize bytes are held in memory, the blocks whose
+	   heights are farthest from the next height to write are evicted: to an
+	   append-only temporary spill file when spillDir is set, otherwise they
+	   are dropped and must be fetched from the input again.'''
+	def __init__(self, maxSize, spillDir=None):
+		self.maxSize = maxSize
+		self.spillDir = spillDir
+		self.spillF = None
+		self.data = {} # height -> block data held in memory
+		self.heap = [] # negated heights in self.data, farthest first
+		self.spilled = {} # height -> (offset, size) in spill file
+		self.size = 0
+
+		self.hits = 0
+		self.spillHits = 0
+		self.misses = 0
+		self.spills = 0
+		self.spillBytes = 0
+		self.drops = 0
+
+	def __contains__(self, height):
+		return height in self.data or height in self.spilled
+
+	def admits(self, height, size):
+		'''Return whether caching a block is worthwhile, rather than seeking past
+		   it and fetching it from the input later'''
+		if self.spillDir or self.size + size <= self.maxSize:
+			return True
+		return self.farthest() > height
+
+	def farthest(self):
+		while self.heap and -self.heap[0] not in self.data:
+			heapq.heappop(self.heap)
+		if self.heap:
+			return -self.heap[0]
+		return -1
+
+	def put(self, height, rawblock):
+		self.data[height] = rawblock
+		heapq.heappush(self.heap, -height)
+		self.size += len(rawblock)
+		while self.size > self.maxSize:
+			self.evict(self.farthest())
+
+	def evict(self, height):
+		rawblock = self.data.pop(height)
+		self.size -= len(rawblock)
+		if not self.spillDir:
+			self.drops += 1
+			return
+		if self.spillF is None:
+			self.spillF = tempfile.TemporaryFile(prefix='linearize-spill', dir=self.spillDir)
+		self.spillF.seek(0, os.SEEK_END)
+		self.spilled[height] = (self.spillF.tell(), len(rawblock))
+		self.spillF.write(rawblock)
+		self.spills += 1
+		self.spillBytes += len(rawblock)
+
+	def pop(self, height):
+		'''Remove and return the data for height, or None if it is not cached'''
+		if height in self.data:
+			rawblock = self.data.pop(height)
+			self.size -= len(rawblock)
+			self.hits += 1
+			return rawblock
+		if height in self.spilled:
+			(offset, size) = self.spilled.pop(height)
+			self.spillF.seek(offset)
+			self.spillHits += 1
+			return self.spillF.read(size)
+		self.misses += 1
+		return None
+
+	def close(self):
+		if self.spillF:
+			self.spillF.close()
+			self.spillF = None
+
+	def statsLine(self):
+		return ("Out-of-order cache: %i hits, %i spill hits, %i misses, %i blocks spilled (%i bytes), %i dropped" %
+				(self.hits, self.spillHits, self.misses, self.spills, self.spillBytes, self.drops))
+
+class OutputIndex:
+	'''Sidecar index of the output, with one fixed-width record per height
+	   giving the output file number, and the offset and length of the block
+	   record (including its 8-byte magic and length prefix) in that file'''
+	MAGIC = 'LOI1'
+	RECORD = struct.Struct('<IQI') # output file number, offset, length
+
+	def __init__(self, fname, height):
+		'''Open the index for appending the record of height'''
+		self.fname = fname
+		if height == 0 or not os.path.exists(fname):
+			self.f = open(fname, "wb")
+			self.f.write(self.MAGIC)
+		else:
+			self.f = open(fname, "r+b")
+			self.f.truncate(min(os.fstat(self.f.fileno()).st_size, self.recordOffset(height)))
+			self.f.seek(0, os.SEEK_END)
+
+	@classmethod
+	def recordOffset(cls, height):
+		return len(cls.MAGIC) + height * cls.RECORD.size
+
+	def count(self):
+		return (self.f.tell() - len(self.MAGIC)) // self.RECORD.size
+
+	def append(self, fn, offset, length):
+		self.f.write(self.RECORD.pack(fn, offset, length))
+
+	def flush(self):
+		self.f.flush()
+
+	def close(self):
+		self.f.close()
+
+class BlockIndexReader:
+	'''Random access to blocks in linearize-data output through its output index.
+
+	   output is the bootstrap.dat file, or the directory of blkNNNNN.dat
+	   files, that the index describes. block() and blocks() return
+	   serialized blocks (80-byte header followed by the transactions).'''
+	def __init__(self, index_fname, output):
+		self.output = output
+		self.indexF = open(index_fname, "rb")
+		if self.indexF.read(4) != OutputIndex.MAGIC:
+			raise ValueError("%s is not an output index" % index_fname)
+		self.count = (os.fstat(self.indexF.fileno()).st_size - 4) // OutputIndex.RECORD.size
+		self.files = {}
+
+	def __len__(self):
+		return self.count
+
+	def fileName(self, fn):
+		if os.path.isdir(self.output):
+			return os.path.join(self.output, "blk%05d.dat" % fn)
+		return self.output
+
+	def file(self, fn):
+		if fn not in self.files:
+			self.files[fn] = open(self.fileName(fn), "rb")
+		return self.files[fn]
+
+	def extent(self, height):
+		'''Return (file number, offset, length) of the record of height'''
+		if height < 0 or height >= self.count:
+			raise IndexError(height)
+		self.indexF.seek(OutputIndex.recordOffset(height))
+		return OutputIndex.RECORD.unpack(self.indexF.read(OutputIndex.RECORD.size))
+
+	def block(self, height):
+		(fn, offset, length) = self.extent(height)
+		f = self.file(fn)
+		f.seek(offset + 8)
+		return f.read(length - 8)
+
+	def blocks(self, start, stop):
+		'''Return the blocks of heights start to stop-1, reading the records of
+		   each output file involved with a single seek and read'''
+		stop = min(stop, self.count)
+		if start >= stop:
+			return []
+		self.indexF.seek(OutputIndex.recordOffset(start))
+		data = self.indexF.read((stop - start) * OutputIndex.RECORD.size)
+		extents = [OutputIndex.RECORD.unpack_from(data, i * OutputIndex.RECORD.size)
+				for i in range(stop - start)]
+		result = []
+		i = 0
+		while i < len(extents):
+			# records of consecutive heights in one output file are contiguous
+			j = i
+			while j + 1 < len(extents) and extents[j + 1][0] == extents[i][0]:
+				j += 1
+			(fn, first, length) = extents[i]
+			f = self.file(fn)
+			f.seek(first)
+			chunk = f.read(extents[j][1] + extents[j][2] - first)
+			for (fn, offset, length) in extents[i:j + 1]:
+				result.append(chunk[offset - first + 8:offset - first + length])
+			i = j + 1
+		return result
+
+	def close(self):
+		self.indexF.close()
+		for f in self.files.values():
+			f.close()
+		self.files = {}
+
+class OutputDigest:
+	'''Incremental SHA-256 of one output file, and of each chunkSize-byte
+	   chunk of it, updated as the file is written'''
+	def __init__(self, chunkSize):
+		self.chunkSize = chunkSize
+		self.fileHash = hashlib.sha256()
+		self.chunkHash = hashlib.sha256()
+		self.chunkLen = 0
+		self.chunks = []
+		self.size = 0
+
+	def update(self, data):
+		pos = 0
+		while pos < len(data):
+			n = min(len(data) - pos, self.chunkSize - self.chunkLen)
+			if pos == 0 and n == len(data):
+				piece = data
+			else:
+				piece = view_slice(data, pos, n)
+			self.fileHash.update(piece)
+			self.chunkHash.update(piece)
+			self.chunkLen += n
+			pos += n
+			if self.chunkLen == self.chunkSize:
+				self.chunks.append(self.chunkHash.hexdigest())
+				self.chunkHash = hashlib.sha256()
+				self.chunkLen = 0
+		self.size += len(data)
+
+	def updateFromFile(self, fname, length):
+		'''Digest the first length bytes of an existing file'''
+		with open(fname, "rb") as f:
+			while length > 0:
+				data = f.read(min(length, COPY_CHUNK))
+				if not data:
+					raise IOError("%s is shorter than expected" % fname)
+				self.update(data)
+				length -= len(data)
+
+	def result(self):
+		chunks = list(self.chunks)
+		if self.chunkLen:
+			chunks.append(self.chunkHash.hexdigest())
+		return { 'size' : self.size, 'sha256' : self.fileHash.hexdigest(), 'chunks' : chunks }
+
+class DigestedOutput:
+	'''File-like wrapper passing everything written through an OutputDigest'''
+	def __init__(self, f, digest):
+		self.f = f
+		self.digest = digest
+
+	def write(self, data):
+		self.digest.update(data)
+		self.f.write(data)
+
+	def flush(self):
+		self.f.flush()
+
+	def fileno(self):
+		return self.f.fileno()
+
+	def close(self):
+		self.f.close()
+
+def compress_chunk(job):
+	'''Process pool entry point: compress one chunk of output'''
+	(codec, level, data) = job
+	if codec == 'lzma':
+		return lzma.compress(data, preset=level)
+	return zlib.compress(data, level)
+
+def decompress_chunk(job):
+	'''Process pool entry point: decompress one chunk of output'''
+	(codec, data) = job
+	if codec == 'lzma':
+		return lzma.decompress(data)
+	return zlib.decompress(data)
+
+class ChunkIndex:
+	'''Chunk index of compressed output: a header naming the codec, then one
+	   fixed-width record per chunk with the first height and number of blocks
+	   in the chunk, its offset and length in the compressed file, and its
+	   uncompressed length. Chunks always hold whole blocks.'''
+	MAGIC = 'LCI1'
+	HEADER = struct.Struct('<8s')
+	RECORD = struct.Struct('<IIQII')
+
+	def __init__(self, fname):
+		with open(fname, "rb") as f:
+			if f.read(4) != self.MAGIC:
+				raise ValueError("%s is not a chunk index" % fname)
+			self.codec = self.HEADER.unpack(f.read(self.HEADER.size))[0].rstrip('\0')
+			data = f.read()
+		n = len(data) // self.RECORD.size
+		self.chunks = [self.RECORD.unpack_from(data, i * self.RECORD.size) for i in range(n)]
+		self.heights = [chunk[0] for chunk in self.chunks]
+
+	def __len__(self):
+		return len(self.chunks)
+
+	def blockCount(self):
+		if not self.chunks:
+			return 0
+		return self.chunks[-1][0] + self.chunks[-1][1]
+
+	def find(self, height):
+		'''Return the number of the chunk holding height'''
+		if height < 0 or height >= self.blockCount():
+			raise IndexError(height)
+		return bisect.bisect_right(self.heights, height) - 1
+
+class CompressedOutput:
+	'''File-like output that compresses whole blocks in chunks of about
+	   chunkSize bytes, on a pool of worker processes. Chunks are independent
+	   compressed streams written in order, and each is recorded in a chunk
+	   index as it is written. At most two chunks per worker are pending.'''
+	def __init__(self, f, indexFname, codec, level, chunkSize, workers):
+		self.f = f
+		self.codec = codec
+		self.level = level
+		self.chunkSize = chunkSize
+		self.indexF = open(indexFname, "wb")
+		self.indexF.write(ChunkIndex.MAGIC + ChunkIndex.HEADER.pack(codec))
+		if workers > 1:
+			self.pool = multiprocessing.Pool(workers)
+		else:
+			self.pool = None
+		self.maxPending = 2 * max(workers, 1)
+		self.pending = deque() # (height, blocks, uncompressed size, result)
+		self.buf = []
+		self.bufSize = 0
+		self.height = 0
+		self.blocks = 0
+		self.offset = 0
+
+	def write(self, data):
+		self.buf.append(bytes(data))
+		self.bufSize += len(data)
+
+	def endBlock(self):
+		'''Called after each complete block record; starts compressing the
+		   current chunk once it has reached chunkSize'''
+		self.blocks += 1
+		if self.bufSize >= self.chunkSize:
+			self.submitChunk()
+
+	def submitChunk(self):
+		if not self.blocks:
+			return
+		while len(self.pending) >= self.maxPending:
+			self.writeChunk()
+		job = (self.codec, self.level, ''.join(self.buf))
+		if self.pool:
+			result = self.pool.apply_async(compress_chunk, (job,))
+		else:
+			result = compress_chunk(job)
+		self.pending.append((self.height, self.blocks, self.bufSize, result))
+		self.height += self.blocks
+		self.blocks = 0
+		self.buf = []
+		self.bufSize = 0
+
+	def writeChunk(self):
+		(height, blocks, size, result) = self.pending.popleft()
+		if self.pool:
+			result = result.get()
+		self.f.write(result)
+		self.indexF.write(ChunkIndex.RECORD.pack(height, blocks, self.offset, len(result), size))
+		self.offset += len(result)
+
+	def close(self):
+		self.submitChunk()
+		while self.pending:
+			self.writeChunk()
+		if self.pool:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+		self.f.close()
+		self.indexF.close()
+
+class StreamOutput:
+	'''File-like output to a stream (stdout, a named pipe or a TCP
+	   connection), written by a background thread. Up to bufferSize bytes
+	   are queued; beyond that write() blocks until the consumer has caught
+	   up, so a slow importer throttles the copy instead of growing memory.'''
+	def __init__(self, f, bufferSize):
+		self.f = f
+		self.bufferSize = bufferSize
+		self.queue = deque()
+		self.queued = 0
+		self.closed = False
+		self.error = None
+		self.cond = threading.Condition()
+		self.thread = threading.Thread(target=self.drain)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def write(self, data):
+		data = bytes(data)
+		with self.cond:
+			while self.queued and self.queued + len(data) > self.bufferSize and self.error is None:
+				self.cond.wait(1.0)
+			if self.error is not None:
+				raise IOError("Output stream failed: %s" % self.error)
+			self.queue.append(data)
+			self.queued += len(data)
+			self.cond.notify_all()
+
+	def drain(self):
+		while True:
+			with self.cond:
+				while not self.queue and not self.closed:
+					self.cond.wait(1.0)
+				if not self.queue:
+					break
+				data = self.queue[0]
+			try:
+				self.f.write(data)
+			except (IOError, socket.error) as e:
+				with self.cond:
+					self.error = e
+					self.cond.notify_all()
+				return
+			with self.cond:
+				self.queue.popleft()
+				self.queued -= len(data)
+				self.cond.notify_all()
+		try:
+			self.f.flush()
+		except (IOError, socket.error) as e:
+			self.error = e
+
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+		while self.thread.is_alive():
+			self.thread.join(1.0)
+		try:
+			self.f.close()
+		except (IOError, socket.error):
+			pass
+		if self.error is not None:
+			raise IOError("Output stream failed: %s" % self.error)
+
+# Descriptor of the real stdout once it is reserved for block data
+stdout_fd = None
+
+def reserve_stdout():
+	'''Keep the real stdout for streamed block data, and send everything
+	   printed from here on to stderr'''
+	global stdout_fd
+	sys.stdout.flush()
+	stdout_fd = os.dup(sys.stdout.fileno())
+	os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+def open_output_stream(target, bufferSize):
+	'''Open "-" (stdout), "tcp:HOST:PORT" (listen there and stream to the
+	   first connection) or a path, typically a named pipe, for streaming'''
+	if target == '-':
+		if stdout_fd is None:
+			reserve_stdout()
+		f = os.fdopen(stdout_fd, "wb")
+	elif target.startswith('tcp:'):
+		(host, port) = target[4:].rsplit(':', 1)
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		listener.bind((host, int(port)))
+		listener.listen(1)
+		print("Waiting for a connection on %s" % target)
+		(conn, addr) = listener.accept()
+		listener.close()
+		print("Streaming to %s:%i" % addr[:2])
+		f = conn.makefile("wb")
+		conn.close()
+	else:
+		# Opening a named pipe waits here until the reader has opened it
+		f = open(target, "wb")
+	return StreamOutput(f, bufferSize)
+
+class SizeRotation:
+	'''Output policy: start a new output file when the next block would take
+	   the current one past maxOutSz'''
+	def __init__(self, maxOutSz):
+		self.maxOutSz = maxOutSz
+
+	def full(self, outsz, blockSize):
+		return outsz > 0 and (outsz + blockSize) > self.maxOutSz
+
+	def rotate(self, copier, blockSize, blk_hdr):
+		return copier.outF is not None and self.full(copier.outsz, blockSize)
+
+class MonthRotation:
+	'''Output policy: start a new output file with the first block of each
+	   month (split_timestamp)'''
+	def rotate(self, copier, blockSize, blk_hdr):
+		(blkDate, blkTS) = get_blk_dt(blk_hdr)
+		if blkDate > copier.lastDate:
+			print("New month " + blkDate.strftime("%Y-%m") + " @ " + calc_hash_str(blk_hdr))
+			copier.lastDate = blkDate
+			return True
+		return False
+
+def output_policies(settings):
+	'''Rotation policies for the configured output, applied in order to
+	   every block before it is written'''
+	policies = []
+	if 'output' in settings:
+		policies.append(SizeRotation(settings['max_out_sz']))
+	if settings['split_timestamp'] != 0:
+		policies.append(MonthRotation())
+	return policies
+
+class Telemetry:
+	'''I/O, hashing and cache counters for a copier run, periodically written
+	   as JSON lines to a file (or stdout for "-"), followed by a summary'''
+	def __init__(self, fname, interval):
+		if not fname:
+			self.f = None
+		elif fname == '-':
+			self.f = sys.stdout
+		else:
+			self.f = open(fname, "a")
+		self.interval = interval
+		self.startTime = time.time()
+		self.lastTime = self.startTime
+		self.lastCounts = (0, 0, 0)
+
+		self.bytesRead = 0
+		self.bytesWritten = 0
+		self.readTime = 0.0
+		self.writeTime = 0.0
+		self.hashTime = 0.0
+		self.discoverTime = 0.0
+		self.headersScanned = 0
+		self.seeks = 0
+		self.opens = 0
+		self.reopens = 0
+		self.openedFiles = set()
+
+	def opened(self, fn):
+		self.opens += 1
+		if fn in self.openedFiles:
+			self.reopens += 1
+		self.openedFiles.add(fn)
+
+	def record(self, copier, event, now):
+		cache = copier.outOfOrderCache
+		lookups = cache.hits + cache.spillHits + cache.misses
+		rec = {
+			'event' : event,
+			'time' : now,
+			'elapsed' : now - self.startTime,
+			'height' : copier.blkCountOut,
+			'blocks_scanned' : copier.blkCountIn,
+			'blocks_written' : copier.blkCountOut,
+			'bytes_read' : self.bytesRead,
+			'bytes_written' : self.bytesWritten,
+			'cache_bytes' : cache.size,
+			'cache_blocks' : len(cache.data),
+			'cache_spilled_blocks' : len(cache.spilled),
+			'cache_hits' : cache.hits,
+			'cache_spill_hits' : cache.spillHits,
+			'cache_misses' : cache.misses,
+			'cache_hit_rate' : (cache.hits + cache.spillHits) / lookups if lookups else None,
+			'opens' : self.opens,
+			'reopens' : self.reopens,
+			'seeks' : self.seeks,
+			'range_copies' : copier.rangeCopies,
+			'headers_scanned' : self.headersScanned,
+			'discover_seconds' : self.discoverTime,
+			'hash_seconds' : self.hashTime,
+			'read_seconds' : self.readTime,
+			'write_seconds' : self.writeTime,
+		}
+		(blocks, bytesRead, bytesWritten) = self.lastCounts
+		if event == 'summary':
+			(blocks, bytesRead, bytesWritten) = (0, 0, 0)
+			span = now - self.startTime
+		else:
+			span = now - self.lastTime
+		span = max(span, 1e-9)
+		rec['blocks_per_sec'] = (copier.blkCountOut - blocks) / span
+		rec['read_mb_per_sec'] = (self.bytesRead - bytesRead) / span / 1e6
+		rec['write_mb_per_sec'] = (self.bytesWritten - bytesWritten) / span / 1e6
+		return rec
+
+	def progress(self, copier):
+		if self.f is None:
+			return
+		now = time.time()
+		if now - self.lastTime < self.interval:
+			return
+		self.write(self.record(copier, 'progress', now))
+		self.lastTime = now
+		self.lastCounts = (copier.blkCountOut, self.bytesRead, self.bytesWritten)
+
+	def summary(self, copier):
+		if self.f is None:
+			return
+		self.write(self.record(copier, 'summary', time.time()))
+		if self.f is not sys.stdout:
+			self.f.close()
+		self.f = None
+
+	def write(self, rec):
+		self.f.write(json.dumps(rec, sort_keys=True) + '\n')
+		self.f.flush()
+
 class BlockDataCopier:
+	# Largest gap between two planned reads in the same file that is read
+	# through rather than seeked over
+	PLAN_MAX_GAP = 1024 * 1024
+	# Gap bytes read through in a batch are at most its size divided by this,
+	# as blocks in the gaps are discarded and read again in a later batch
+	PLAN_GAP_DIVISOR = 8
+
 	def __init__(self, settings, blkindex, blkmap):
 		self.settings = settings
 		self.blkindex = blkindex
 		self.blkmap = blkmap
+		# With hashes streamed from RPC there is no blkmap: blocks found in the
+		# input are matched to heights as their hashes arrive
+		self.streamHashes = isinstance(blkindex, RPCHashStream)
+		self.extentsByHash = {}
+		self.resolvedHeight = 0
+		self.extentLastUse = {} # input file number -> last height read from it
+		self.extentHeights = {} # (input file number, offset) -> height
+		# With several input directories, input file numbers index this list
+		# of the files in all of them
+		self.inputFiles = None
 
 		self.inFn = 0
 		self.inF = None
@@ -100,103 +1251,428 @@ class BlockDataCopier:
 		self.outsz = 0
 		self.outF = None
 		self.outFname = None
+		self.lastOutOffset = 0
 		self.blkCountIn = 0
 		self.blkCountOut = 0
 
 		self.lastDate = datetime.datetime(2000, 1, 1)
 		self.highTS = 1408893517 - 315360000
-		self.timestampSplit = False
 		self.fileOutput = True
 		self.setFileTime = False
+		self.inputMmap = settings['input_mmap'] != 0
 		self.maxOutSz = settings['max_out_sz']
+		self.checkpointFile = settings['checkpoint']
 		if 'output' in settings:
 			self.fileOutput = False
 		if settings['file_timestamp'] != 0:
 			self.setFileTime = True
-		if settings['split_timestamp'] != 0:
-			self.timestampSplit = True
+		self.outputStream = settings.get('output_stream')
+		self.policies = output_policies(settings)
         # Extents and cache for out-of-order blocks
 		self.blockExtents = {}
-		self.outOfOrderData = {}
-		self.outOfOrderSize = 0 # running total size for items in outOfOrderData
+		# Pending direct copy of adjacent in-order block records: [fn, start, end]
+		self.rangeCopy = settings['range_copy'] != 0
+		self.pendingCopy = None
+		self.copyInFn = None
+		self.copyInF = None
+		self.rangeCopies = 0
+		self.outIndex = None
+		# Digest of the current output file, and manifest entries of the
+		# files completed so far
+		self.outDigest = None
+		self.outFirstHeight = 0
+		self.manifestFiles = []
+		self.telemetry = Telemetry(settings['metrics_file'], settings['metrics_interval'])
+		self.outOfOrderCache = OutOfOrderCache(settings['out_of_order_cache_sz'],
+				settings['spill_dir'] or None)
 
-	def writeBlock(self, inhdr, blk_hdr, rawblock):
-		if not self.fileOutput and ((self.outsz + self.inLen) > self.maxOutSz):
-			self.outF.close()
-			if self.setFileTime:
-				os.utime(outFname, (int(time.time()), highTS))
-			self.outF = None
-			self.outFname = None
-			self.outFn = outFn + 1
-			self.outsz = 0
+	def closeOutput(self):
+		self.flushRangeCopy()
+		self.outF.close()
+		if self.setFileTime:
+			os.utime(self.outFname, (int(time.time()), self.highTS))
+		if self.outDigest:
+			self.manifestFiles.append(self.manifestEntry(self.outFn, self.outFirstHeight, self.outDigest.result()))
+			self.outDigest = None
+		self.outF = None
+		self.outFname = None
+		self.outFn = self.outFn + 1
+		self.outsz = 0
 
-		(blkDate, blkTS) = get_blk_dt(blk_hdr)
-		if self.timestampSplit and (blkDate > self.lastDate):
-			print("New month " + blkDate.strftime("%Y-%m") + " @ " + hash_str)
-			lastDate = blkDate
-			if outF:
-				outF.close()
-				if setFileTime:
-					os.utime(outFname, (int(time.time()), highTS))
-				self.outF = None
-				self.outFname = None
-				self.outFn = self.outFn + 1
-				self.outsz = 0
+	def startBlock(self, blockSize, blk_hdr):
+		'''Rotate output files as needed before writing a block record of
+		   blockSize bytes, and make sure an output file is open.
+		   Returns the block timestamp.'''
+		for policy in self.policies:
+			if policy.rotate(self, blockSize, blk_hdr) and self.outF:
+				self.closeOutput()
 
+		(blkDate, blkTS) = get_blk_dt(blk_hdr)
 		if not self.outF:
-			if self.fileOutput:
-				outFname = self.settings['output_file']
+			self.outFname = self.outFileName(self.outFn)
+			print("Output file " + self.outFname)
+			if self.outputStream:
+				self.outF = open_output_stream(self.outputStream, self.settings['stream_buffer_sz'])
 			else:
-				outFname = "%s/blk%05d.dat" % (self.settings['output'], outFn)
-			print("Output file" + outFname)
-			self.outF = open(outFname, "wb")
-
-		self.outF.write(inhdr)
-		self.outF.write(blk_hdr)
-		self.outF.write(rawblock)
-		self.outsz = self.outsz + len(inhdr) + len(blk_hdr) + len(rawblock)
+				self.outF = open(self.outFname, "wb")
+			if self.settings['manifest']:
+				self.outDigest = OutputDigest(self.settings['manifest_chunk_sz'])
+				self.outFirstHeight = self.blkCountOut
+				self.outF = DigestedOutput(self.outF, self.outDigest)
+			if self.settings['compress']:
+				self.outF = CompressedOutput(self.outF, self.outFname + '.chunks',
+						self.settings['compress'], self.settings['compress_level'],
+						self.settings['compress_chunk_sz'], self.settings['compress_workers'])
+		return blkTS
 
+	def finishBlock(self, blockSize, blkTS):
+		self.lastOutOffset = self.outsz
+		if self.outIndex:
+			self.outIndex.append(self.outFn, self.outsz, blockSize)
+		self.outsz = self.outsz + blockSize
 		self.blkCountOut = self.blkCountOut + 1
+		if self.settings['compress']:
+			self.outF.endBlock()
 		if blkTS > self.highTS:
 			self.highTS = blkTS
 
 		if (self.blkCountOut % 1000) == 0:
 			print('%i blocks scanned, %i blocks written (of %i, %.1f%% complete)' % 
 					(self.blkCountIn, self.blkCountOut, len(self.blkindex), 100.0 * self.blkCountOut / len(self.blkindex)))
+		if self.checkpointFile and (self.blkCountOut % self.settings['checkpoint_interval']) == 0:
+			self.writeCheckpoint()
+		self.telemetry.progress(self)
+
+	def finishOutput(self):
+		if self.checkpointFile and self.outF:
+			self.writeCheckpoint()
+		if self.outF:
+			self.closeOutput()
+		if self.copyInF:
+			self.copyInF.close()
+			self.copyInF = None
+		if self.outIndex:
+			self.outIndex.close()
+			self.outIndex = None
+		if self.settings['manifest']:
+			self.writeManifest()
+		self.telemetry.summary(self)
+
+	def writeCheckpoint(self):
+		'''Make the output durable up to the last block written, then record
+		   where it ends so that an interrupted run can resume from there'''
+		self.flushRangeCopy()
+		if self.outF:
+			self.outF.flush()
+			os.fsync(self.outF.fileno())
+		if self.outIndex:
+			self.outIndex.flush()
+		checkpoint = {
+			'height' : self.blkCountOut,
+			'hash' : hash_to_str(self.blkindex[self.blkCountOut - 1]),
+			'outFn' : self.outFn,
+			'outsz' : self.outsz,
+			'lastOffset' : self.lastOutOffset,
+			'highTS' : self.highTS,
+			'lastDate' : self.lastDate.strftime("%Y-%m"),
+		}
+		tmpname = self.checkpointFile + '.tmp'
+		with open(tmpname, "w") as f:
+			json.dump(checkpoint, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmpname, self.checkpointFile)
+
+	def manifestEntry(self, fn, firstHeight, digest):
+		'''Manifest entry for output file fn, just completed up to blkCountOut'''
+		entry = {
+			'file' : os.path.basename(self.outFileName(fn)),
+			'blocks' : self.blkCountOut - firstHeight,
+			'first_height' : firstHeight,
+			'last_height' : self.blkCountOut - 1,
+			'highTS' : self.highTS,
+		}
+		entry.update(digest)
+		return entry
+
+	def writeManifest(self):
+		manifest = {
+			'blocks' : self.blkCountOut,
+			'highTS' : self.highTS,
+			'chunk_size' : self.settings['manifest_chunk_sz'],
+			'files' : self.manifestFiles,
+		}
+		tmpname = self.settings['manifest'] + '.tmp'
+		with open(tmpname, "w") as f:
+			json.dump(manifest, f, indent=1, sort_keys=True)
+		os.rename(tmpname, self.settings['manifest'])
+		print("Wrote manifest of %i output files to %s" % (len(self.manifestFiles), self.settings['manifest']))
+
+	def resumeManifest(self):
+		'''Set up manifest entries for the output files written by earlier
+		   runs, reusing those of an existing manifest where the file is
+		   unchanged, and digest the part of the current file already written'''
+		old = {}
+		if os.path.exists(self.settings['manifest']):
+			with open(self.settings['manifest']) as f:
+				for entry in json.load(f)['files']:
+					old[entry['file']] = entry
+		(firstHeight, highTS) = (0, 0)
+		for fn in range(self.outFn):
+			fname = self.outFileName(fn)
+			entry = old.get(os.path.basename(fname))
+			if (entry is None or entry['first_height'] != firstHeight or entry['size'] != os.path.getsize(fname) or
+					len(entry['chunks']) != -(-entry['size'] // self.settings['manifest_chunk_sz'])):
+				print("Digesting %s for the manifest" % fname)
+				(blocks, end) = scan_block_file(fname, self.settings['netmagic'], headers=True)
+				for (hash, offset, size, blk_hdr) in blocks:
+					highTS = max(highTS, get_blk_dt(blk_hdr)[1])
+				digest = OutputDigest(self.settings['manifest_chunk_sz'])
+				digest.updateFromFile(fname, os.path.getsize(fname))
+				entry = {
+					'file' : os.path.basename(fname),
+					'blocks' : len(blocks),
+					'first_height' : firstHeight,
+					'last_height' : firstHeight + len(blocks) - 1,
+					'highTS' : highTS,
+				}
+				entry.update(digest.result())
+			self.manifestFiles.append(entry)
+			(firstHeight, highTS) = (entry['last_height'] + 1, entry['highTS'])
+
+		self.outFirstHeight = firstHeight
+		self.outDigest = OutputDigest(self.settings['manifest_chunk_sz'])
+		self.outDigest.updateFromFile(self.outFname, self.outsz)
+		self.outF = DigestedOutput(self.outF, self.outDigest)
+
+	def outFileName(self, fn):
+		if self.outputStream:
+			return self.outputStream
+		if self.fileOutput:
+			return self.settings['output_file']
+		return os.path.join(self.settings['output'], "blk%05d.dat" % fn)
+
+	def findOutputEnd(self):
+		'''Locate the last complete block record in existing output by scanning it.
+		   Returns a checkpoint-style dict, or None if there is no output yet.'''
+		height = 0
+		fn = 0
+		found = None
+		while os.path.exists(self.outFileName(fn)):
+			(blocks, end) = scan_block_file(self.outFileName(fn), self.settings['netmagic'])
+			if blocks:
+				height += len(blocks)
+				found = { 'height' : height, 'hash' : hash_to_str(blocks[-1][0]), 'outFn' : fn,
+						'outsz' : end, 'lastOffset' : blocks[-1][1] - 88 }
+			if self.fileOutput:
+				break
+			fn += 1
+		if found is None:
+			return None
+
+		with open(self.outFileName(found['outFn']), "rb") as f:
+			f.seek(found['lastOffset'] + 8)
+			(blkDate, blkTS) = get_blk_dt(f.read(80))
+		found['highTS'] = blkTS
+		found['lastDate'] = blkDate.strftime("%Y-%m")
+		return found
+
+	def resumeOutput(self):
+		'''Continue after the last block of a previous run, from the checkpoint
+		   file if there is one and by scanning the existing output otherwise.
+		   Returns False if the existing output does not match the hashlist.'''
+		checkpoint = None
+		if self.checkpointFile and os.path.exists(self.checkpointFile):
+			with open(self.checkpointFile) as f:
+				checkpoint = json.load(f)
+			print("Resuming from checkpoint at height %i" % checkpoint['height'])
+		else:
+			checkpoint = self.findOutputEnd()
+			if checkpoint is None:
+				print("No existing output, starting at height 0")
+				return True
+			print("Existing output ends at height %i" % checkpoint['height'])
+
+		height = checkpoint['height']
+		outFname = self.outFileName(checkpoint['outFn'])
+		if height > len(self.blkindex) or hash_to_str(self.blkindex[height - 1]) != checkpoint['hash']:
+			print("Block %s at height %i of existing output is not in the hashlist" % (checkpoint['hash'], height - 1))
+			return False
+		with open(outFname, "rb") as f:
+			f.seek(checkpoint['lastOffset'])
+			inhdr = f.read(8)
+			if len(inhdr) < 8 or calc_hash_str(f.read(80)) != checkpoint['hash']:
+				print("Last block of %s does not match the checkpoint" % outFname)
+				return False
+			if inhdr[:4] != self.settings['netmagic'] or os.fstat(f.fileno()).st_size < checkpoint['outsz']:
+				print("%s is shorter than the checkpoint" % outFname)
+				return False
+
+		# Discard anything written after the checkpoint, and append from there
+		self.outFn = checkpoint['outFn']
+		self.outsz = checkpoint['outsz']
+		self.lastOutOffset = checkpoint['lastOffset']
+		self.outFname = outFname
+		self.outF = open(outFname, "r+b")
+		self.outF.truncate(self.outsz)
+		self.outF.seek(self.outsz)
+		self.blkCountOut = height
+		self.highTS = max(self.highTS, checkpoint['highTS'])
+		self.lastDate = datetime.datetime.strptime(checkpoint['lastDate'], "%Y-%m")
+		if self.settings['manifest']:
+			self.resumeManifest()
+		return True
+
+	def writeBlock(self, inhdr, blk_hdr, rawblock):
+		blockSize = len(inhdr) + len(blk_hdr) + len(rawblock)
+		blkTS = self.startBlock(blockSize, blk_hdr)
+		self.flushRangeCopy()
+		start = time.time()
+		self.outF.write(inhdr + blk_hdr)
+		self.outF.write(rawblock)
+		self.telemetry.writeTime += time.time() - start
+		self.telemetry.bytesWritten += blockSize
+		self.finishBlock(blockSize, blkTS)
+
+	def copyInput(self, fn):
+		'''Input file handle used for range copies, kept open while fn is unchanged'''
+		if self.copyInFn != fn:
+			if self.copyInF:
+				self.copyInF.close()
+			self.copyInF = open(self.inFileName(fn), "rb")
+			self.copyInFn = fn
+			self.telemetry.opened(fn)
+		return self.copyInF
+
+	def queueRangeCopy(self, extent):
+		'''Write a block by copying its record straight from the input file,
+		   merged with the previous range copy when the two are adjacent on disk'''
+		blk_hdr = extent.blkhdr
+		if blk_hdr is None:
+			f = self.copyInput(extent.fn)
+			self.seekInput(f, extent.offset - 80)
+			blk_hdr = self.readInput(f, 80)
+		blockSize = extent.size + 88
+		blkTS = self.startBlock(blockSize, blk_hdr)
+
+		start = extent.offset - 88
+		end = extent.offset + extent.size
+		if self.pendingCopy and self.pendingCopy[0] == extent.fn and self.pendingCopy[2] == start:
+			self.pendingCopy[2] = end
+		else:
+			self.flushRangeCopy()
+			self.pendingCopy = [extent.fn, start, end]
+		self.finishBlock(blockSize, blkTS)
+
+	def flushRangeCopy(self):
+		if not self.pendingCopy:
+			return
+		(fn, start, end) = self.pendingCopy
+		self.pendingCopy = None
+		inF = self.copyInput(fn)
+		copyStart = time.time()
+		copy_range(inF, self.outF, start, end - start)
+		self.rangeCopies += 1
+		self.telemetry.seeks += 1
+		self.telemetry.writeTime += time.time() - copyStart
+		self.telemetry.bytesRead += end - start
+		self.telemetry.bytesWritten += end - start
 
 	def inFileName(self, fn):
+		if self.inputFiles is not None:
+			return self.inputFiles[fn]
 		return "%s/blk%05d.dat" % (self.settings['input'], fn)
 
+	def openInput(self, fn):
+		fname = self.inFileName(fn)
+		print("Input file" + fname)
+		self.telemetry.opened(fn)
+		if self.inputMmap:
+			return MappedBlockFile(fname)
+		return open(fname, "rb")
+
+	def readInput(self, f, n):
+		start = time.time()
+		data = f.read(n)
+		self.telemetry.readTime += time.time() - start
+		self.telemetry.bytesRead += len(data)
+		return data
+
+	def seekInput(self, f, offset, whence=os.SEEK_SET):
+		f.seek(offset, whence)
+		self.telemetry.seeks += 1
+
+	def hashHeader(self, blk_hdr):
+		start = time.time()
+		hash = calc_hdr_hash(blk_hdr)
+		self.telemetry.hashTime += time.time() - start
+		return hash
+
 	def fetchBlock(self, extent):
 		'''Fetch block contents from disk given extents'''
 		with open(self.inFileName(extent.fn), "rb") as f:
-			f.seek(extent.offset)
-			return f.read(extent.size)
+			self.telemetry.opened(extent.fn)
+			self.seekInput(f, extent.offset)
+			return self.readInput(f, extent.size)
 
 	def copyOneBlock(self):
 		'''Find the next block to be written in the input, and copy it to the output.'''
 		extent = self.blockExtents.pop(self.blkCountOut)
-		if self.blkCountOut in self.outOfOrderData:
-			# If the data is cached, use it from memory and remove from the cache
-			rawblock = self.outOfOrderData.pop(self.blkCountOut)
-			self.outOfOrderSize -= len(rawblock)
-		else: # Otherwise look up data on disk
+		# If the data is cached, use it and remove it from the cache
+		rawblock = self.outOfOrderCache.pop(self.blkCountOut)
+		if rawblock is None and self.rangeCopy:
+			self.queueRangeCopy(extent)
+			return
+		if rawblock is None: # Otherwise look up data on disk
 			rawblock = self.fetchBlock(extent)
 
 		self.writeBlock(extent.inhdr, extent.blkhdr, rawblock)
 
+	def openOutputIndex(self):
+		'''Open the output index for appending, first rebuilding any records
+		   it lacks for output written by earlier runs'''
+		self.outIndex = OutputIndex(self.settings['output_index'], self.blkCountOut)
+		if self.outIndex.count() == self.blkCountOut:
+			return
+		print("Rebuilding output index from existing output")
+		self.outIndex.close()
+		self.outIndex = OutputIndex(self.settings['output_index'], 0)
+		fn = 0
+		while self.outIndex.count() < self.blkCountOut:
+			(blocks, end) = scan_block_file(self.outFileName(fn), self.settings['netmagic'])
+			for (hash, offset, size) in blocks[:self.blkCountOut - self.outIndex.count()]:
+				self.outIndex.append(fn, offset - 88, size + 88)
+			self.outIndex.flush()
+			fn += 1
+
 	def run(self):
+		if self.settings['resume'] and not self.resumeOutput():
+			return
+		if self.settings['output_index']:
+			self.openOutputIndex()
+		if self.settings['shard_workers'] > 1:
+			self.discoverExtents()
+			self.runSharded()
+			return
+		if self.settings['copy_planner']:
+			self.discoverExtents()
+			self.runPlanned()
+			return
+		if (self.streamHashes or self.settings['extent_index'] or self.settings['scan_workers'] > 1 or
+				len(self.settings['input_dirs']) > 1):
+			self.discoverExtents()
+			self.runFromExtents()
+			return
+
 		while self.blkCountOut < len(self.blkindex):
 			if not self.inF:
-				fname = self.inFileName(self.inFn)
-				print("Input file" + fname)
 				try:
-					self.inF = open(fname, "rb")
-				except IOError:
+					self.inF = self.openInput(self.inFn)
+				except (IOError, OSError):
 					print("Premature end of block data")
-					return
+					break
 
-			inhdr = self.inF.read(8)
+			inhdr = bytes(self.readInput(self.inF, 8))
 			if (not inhdr or (inhdr[0] == "\0")):
 				self.inF.close()
 				self.inF = None
@@ -206,26 +1682,33 @@ class BlockDataCopier:
 			inMagic = inhdr[:4]
 			if (inMagic != self.settings['netmagic']):
 				print("Invalid magic:" + inMagic)
-				return
+				break
 			inLenLE = inhdr[4:]
 			su = struct.unpack("<I", inLenLE)
 			inLen = su[0] - 80 # length without header
-			blk_hdr = self.inF.read(80)
+			blk_hdr = bytes(self.readInput(self.inF, 80))
 			inExtent = BlockExtent(self.inFn, self.inF.tell(), inhdr, blk_hdr, inLen)
 
-			hash_str = calc_hash_str(blk_hdr)
-			if not hash_str in blkmap:
-				print("Skipping unknown block " + hash_str)
-				self.inF.seek(inLen, os.SEEK_CUR)
+			blkHeight = self.blkmap.get(self.hashHeader(blk_hdr))
+			if blkHeight is None:
+				print("Skipping unknown block " + calc_hash_str(blk_hdr))
+				self.seekInput(self.inF, inLen, os.SEEK_CUR)
 				continue
 
-			blkHeight = self.blkmap[hash_str]
+			if blkHeight < self.blkCountOut:
+				# Already in the output of a previous run
+				self.seekInput(self.inF, inLen, os.SEEK_CUR)
+				continue
 			self.blkCountIn += 1
 
 			if self.blkCountOut == blkHeight:
 				# If in-order block, just copy
-				rawblock = self.inF.read(inLen)
-				self.writeBlock(inhdr, blk_hdr, rawblock)
+				if self.rangeCopy:
+					self.seekInput(self.inF, inLen, os.SEEK_CUR)
+					self.queueRangeCopy(inExtent)
+				else:
+					rawblock = self.readInput(self.inF, inLen)
+					self.writeBlock(inhdr, blk_hdr, rawblock)
 
 				# See if we can catch up to prior out-of-order blocks
 				while self.blkCountOut in self.blockExtents:
@@ -233,23 +1716,337 @@ class BlockDataCopier:
 
 			else: # If out-of-order, skip over block data for now
 				self.blockExtents[blkHeight] = inExtent
-				if self.outOfOrderSize < self.settings['out_of_order_cache_sz']:
-					# If there is space in the cache, read the data
+				if self.outOfOrderCache.admits(blkHeight, inLen):
+					# If the cache has room, or can make room by evicting blocks needed
+					# later than this one, read the data
 					# Reading the data in file sequence instead of seeking and fetching it later is preferred,
 					# but we don't want to fill up memory
-					self.outOfOrderData[blkHeight] = self.inF.read(inLen)
-					self.outOfOrderSize += inLen
-				else: # If no space in cache, seek forward
-					self.inF.seek(inLen, os.SEEK_CUR)
+					self.outOfOrderCache.put(blkHeight, bytes(self.readInput(self.inF, inLen)))
+				else: # Otherwise seek forward
+					self.seekInput(self.inF, inLen, os.SEEK_CUR)
 
+		self.finishOutput()
+		self.outOfOrderCache.close()
+		print(self.outOfOrderCache.statsLine())
+		if self.rangeCopy:
+			print("%i range copies" % self.rangeCopies)
 		print("Done (%i blocks written)" % (self.blkCountOut))
 
-if __name__ == '__main__':
-	if len(sys.argv) != 2:
-		print("Usage: linearize-data.py CONFIG-FILE")
-		sys.exit(1)
+	def discoverExtents(self):
+		'''Locate every wanted block in the input files.
+		   Files not covered by the extent index are scanned by a pool of
+		   scan_workers processes, or with several input directories by one
+		   process per directory. The results are matched against blkmap here,
+		   in directory order, so the first directory holding a block wins.'''
+		discoverStart = time.time()
+		index = ExtentIndex(self.settings['extent_index'] or None)
+		dirFiles = input_dir_files(self.settings)
+		fnames = list(itertools.chain(*dirFiles))
+		self.inputFiles = fnames
+
+		stats = {}
+		dirJobs = []
+		for files in dirFiles:
+			jobs = []
+			for fname in files:
+				stats[fname] = os.stat(fname)
+				start = index.resumeOffset(fname, stats[fname])
+				if start is not None:
+					jobs.append((fname, self.settings['netmagic'], start))
+			dirJobs.append(jobs)
+		jobs = list(itertools.chain(*dirJobs))
+
+		pool = None
+		if len(dirJobs) > 1:
+			dirJobs = [dirJob for dirJob in dirJobs if dirJob]
+			print("Scanning %i input files in %i directories, one process per directory" % (len(jobs), len(dirJobs)))
+			pool = multiprocessing.Pool(max(1, len(dirJobs)))
+			results = itertools.chain.from_iterable(pool.imap_unordered(scan_block_dir_job, dirJobs))
+		elif min(self.settings['scan_workers'], len(jobs)) > 1:
+			workers = min(self.settings['scan_workers'], len(jobs))
+			print("Scanning %i input files with %i processes" % (len(jobs), workers))
+			pool = multiprocessing.Pool(workers)
+			results = pool.imap_unordered(scan_block_file_job, jobs)
+		else:
+			results = itertools.imap(scan_block_file_job, jobs)
+		for (fname, start, blocks, end) in results:
+			index.update(fname, stats[fname], start, blocks, end)
+			self.telemetry.headersScanned += len(blocks)
+		if pool:
+			pool.close()
+			pool.join()
+		index.save()
+		self.telemetry.discoverTime = time.time() - discoverStart
+
+		if self.streamHashes:
+			for (fn, fname) in enumerate(fnames):
+				for (hash, offset, size) in index.blocks(fname):
+					if hash not in self.extentsByHash:
+						self.extentsByHash[hash] = BlockExtent(fn, offset, None, None, size)
+			self.resolvedHeight = self.blkCountOut
+			print("Found %i blocks in %i input files, %i hashes received so far" %
+					(len(self.extentsByHash), len(fnames), self.blkindex.available()))
+			return
+
+		for (fn, fname) in enumerate(fnames):
+			for (hash, offset, size) in index.blocks(fname):
+				height = self.blkmap.get(hash)
+				if height is not None and height >= self.blkCountOut and height not in self.blockExtents:
+					self.blockExtents[height] = BlockExtent(fn, offset, None, None, size)
+					self.extentHeights[(fn, offset)] = height
+					self.extentLastUse[fn] = max(height, self.extentLastUse.get(fn, height))
+		print("Found %i of %i blocks in %i input files" % (len(self.blockExtents), len(self.blkindex) - self.blkCountOut, len(fnames)))
+
+	def resolveHashes(self, height):
+		'''With hashes streamed from RPC, wait until the hash for height has
+		   arrived, then give an extent to every newly arrived height whose
+		   block was found in the input'''
+		if not self.streamHashes or height < self.resolvedHeight:
+			return
+		available = self.blkindex.available(height)
+		for h in range(self.resolvedHeight, available):
+			extent = self.extentsByHash.pop(self.blkindex[h], None)
+			if extent is not None:
+				self.blockExtents[h] = extent
+				self.extentHeights[(extent.fn, extent.offset)] = h
+				self.extentLastUse[extent.fn] = h
+		self.resolvedHeight = available
+
+	def readExtent(self, extent, handles):
+		'''Read the record headers and data of a discovered block from its
+		   input file in handles, opening the file if it is not open yet'''
+		f = handles.get(extent.fn)
+		if f is None:
+			f = handles[extent.fn] = self.openInput(extent.fn)
+		if f.tell() != extent.offset - 88:
+			self.seekInput(f, extent.offset - 88)
+		inhdr = bytes(self.readInput(f, 8))
+		blk_hdr = bytes(self.readInput(f, 80))
+		return (inhdr, blk_hdr, self.readInput(f, extent.size))
+
+	def readAhead(self, f, fn):
+		'''Cache the records that follow the last read in input file fn and
+		   are written later, while the out-of-order cache admits them, so
+		   they are read in file sequence instead of seeked back to'''
+		while True:
+			height = self.extentHeights.get((fn, f.tell() + 88))
+			extent = self.blockExtents.get(height)
+			if extent is None or extent.fn != fn or height in self.outOfOrderCache:
+				break
+			if not self.outOfOrderCache.admits(height, extent.size + 88):
+				break
+			self.outOfOrderCache.put(height, bytes(self.readInput(f, extent.size + 88)))
+
+	def runFromExtents(self):
+		'''Copy blocks in height order once their locations are known up front,
+		   keeping each input file open until the last height read from it
+		   has been written'''
+		handles = {}
+		while self.blkCountOut < len(self.blkindex):
+			self.resolveHashes(self.blkCountOut)
+			extent = self.blockExtents.pop(self.blkCountOut, None)
+			if extent is None:
+				print("Premature end of block data")
+				break
+			self.blkCountIn += 1
+			# records read ahead are cached whole, with their headers
+			record = self.outOfOrderCache.pop(self.blkCountOut)
+			if record is not None:
+				self.writeBlock(record[:8], record[8:88], view_slice(record, 88, extent.size))
+			elif self.rangeCopy:
+				self.queueRangeCopy(extent)
+			else:
+				(inhdr, blk_hdr, rawblock) = self.readExtent(extent, handles)
+				self.writeBlock(inhdr, blk_hdr, rawblock)
+				self.readAhead(handles[extent.fn], extent.fn)
+
+			for fn in list(handles):
+				if self.extentLastUse[fn] < self.blkCountOut:
+					handles.pop(fn).close()
+
+		self.finishOutput()
+		for f in handles.values():
+			f.close()
+		self.outOfOrderCache.close()
+		print(self.outOfOrderCache.statsLine())
+		if self.rangeCopy:
+			print("%i range copies" % self.rangeCopies)
+		print("Done (%i blocks written)" % (self.blkCountOut))
+
+	def planBatch(self, height):
+		'''Choose the heights to copy next, starting at height, so that their data
+		   fits in out_of_order_cache_sz. Returns (heights, runs), where runs
+		   lists [fn, start, end, heights] file ranges in (file, offset) order,
+		   merging ranges separated by at most PLAN_MAX_GAP bytes while the
+		   gaps merged stay within the batch size over PLAN_GAP_DIVISOR.'''
+		heights = []
+		batchSize = 0
+		while height in self.blockExtents:
+			size = self.blockExtents[height].size + 88
+			if heights and batchSize + size > self.settings['out_of_order_cache_sz']:
+				break
+			heights.append(height)
+			batchSize += size
+			height += 1
+
+		runs = []
+		gapBudget = batchSize // self.PLAN_GAP_DIVISOR
+		for h in sorted(heights, key=lambda h: (self.blockExtents[h].fn, self.blockExtents[h].offset)):
+			extent = self.blockExtents[h]
+			start = extent.offset - 88
+			end = extent.offset + extent.size
+			if runs and runs[-1][0] == extent.fn and 0 <= start - runs[-1][2] <= min(self.PLAN_MAX_GAP, gapBudget):
+				gapBudget -= start - runs[-1][2]
+				runs[-1][2] = end
+				runs[-1][3].append(h)
+			else:
+				runs.append([extent.fn, start, end, [h]])
+		return (heights, runs)
 
-	f = open(sys.argv[1])
+	def runPlanned(self):
+		'''Copy blocks in batches whose reads are sorted by file and offset and
+		   merged into large sequential reads, keeping each input file open
+		   from its first read to its last.'''
+		handles = {}
+		reads = 0
+		seeks = 0
+		opens = 0
+		gapBytes = 0 # read through between planned blocks and discarded
+		# seeks and opens of a plain height-order copy, for comparison
+		naiveSeeks = 0
+		naiveOpens = 0
+		(lastFn, lastEnd) = (None, None)
+		while self.blkCountOut < len(self.blkindex):
+			self.resolveHashes(self.blkCountOut)
+			(heights, runs) = self.planBatch(self.blkCountOut)
+			if not heights:
+				print("Premature end of block data")
+				break
+
+			for h in heights:
+				extent = self.blockExtents[h]
+				if extent.fn != lastFn:
+					naiveOpens += 1
+					naiveSeeks += 1
+				elif extent.offset - 88 != lastEnd:
+					naiveSeeks += 1
+				(lastFn, lastEnd) = (extent.fn, extent.offset + extent.size)
+
+			blocks = {}
+			for (fn, start, end, runHeights) in runs:
+				f = handles.get(fn)
+				if f is None:
+					f = handles[fn] = self.openInput(fn)
+					opens += 1
+				if f.tell() != start:
+					self.seekInput(f, start)
+					seeks += 1
+				data = self.readInput(f, end - start)
+				reads += 1
+				gapBytes += end - start
+				for h in runHeights:
+					extent = self.blockExtents[h]
+					pos = extent.offset - 88 - start
+					gapBytes -= extent.size + 88
+					blocks[h] = (bytes(data[pos:pos+8]), bytes(data[pos+8:pos+88]),
+							view_slice(data, pos + 88, extent.size))
+				data = None
+
+			for h in heights:
+				del self.blockExtents[h]
+				(inhdr, blk_hdr, rawblock) = blocks.pop(h)
+				self.blkCountIn += 1
+				self.writeBlock(inhdr, blk_hdr, rawblock)
+
+			for fn in list(handles):
+				if self.extentLastUse[fn] < self.blkCountOut:
+					handles.pop(fn).close()
+
+		self.finishOutput()
+		for f in handles.values():
+			f.close()
+		print("Planned copy: %i reads, %i seeks (%i avoided), %i file opens (%i avoided), %i bytes read through gaps" %
+				(reads, seeks, naiveSeeks - seeks, opens, naiveOpens - opens, gapBytes))
+		print("Done (%i blocks written)" % (self.blkCountOut))
+
+	def planShards(self):
+		'''Assign the heights from blkCountOut on to output files, rotating at
+		   max_out_sz exactly as the serial writer does. Returns a list of
+		   (fn, start offset, extents) per output file.'''
+		shards = []
+		sizeRotation = SizeRotation(self.maxOutSz)
+		(fn, size) = (self.outFn, self.outsz)
+		height = self.blkCountOut
+		while height < len(self.blkindex):
+			self.resolveHashes(height)
+			extent = self.blockExtents.pop(height, None)
+			if extent is None:
+				print("Premature end of block data")
+				break
+			blockSize = extent.size + 88
+			if sizeRotation.full(size, blockSize):
+				(fn, size) = (fn + 1, 0)
+			if not shards or shards[-1][0] != fn:
+				shards.append((fn, size, []))
+			shards[-1][2].append((self.inFileName(extent.fn), extent.offset, extent.size))
+			size += blockSize
+			height += 1
+		return shards
+
+	def runSharded(self):
+		'''Write every output file in its own worker process, with file
+		   boundaries planned up front from the discovered block sizes.
+		   Results are taken in file order, so the output index and checkpoint
+		   only ever cover a complete prefix of the output.'''
+		shards = self.planShards()
+		if self.outF and shards and shards[0][1]:
+			# A resumed run's last file is appended to by its worker
+			self.outF.close()
+			self.outF = None
+			self.outDigest = None
+		elif self.outF:
+			self.closeOutput()
+		digestChunkSize = self.settings['manifest_chunk_sz'] if self.settings['manifest'] else 0
+		jobs = [(self.outFileName(fn), start, extents, bool(self.checkpointFile), digestChunkSize)
+				for (fn, start, extents) in shards]
+		workers = max(1, min(self.settings['shard_workers'], len(jobs)))
+		print("Writing %i output files with %i processes" % (len(jobs), workers))
+		pool = multiprocessing.Pool(workers)
+		results = pool.imap(write_shard_job, jobs)
+		for ((fn, start, extents), (written, highTS, digest)) in itertools.izip(shards, results):
+			# Only the first file can have been started by an earlier run
+			firstHeight = self.outFirstHeight if start else self.blkCountOut
+			offset = start
+			for (inName, inOffset, size) in extents:
+				if self.outIndex:
+					self.outIndex.append(fn, offset, size + 88)
+				self.lastOutOffset = offset
+				offset += size + 88
+			self.outFn = fn
+			self.outsz = offset
+			self.blkCountIn += len(extents)
+			self.blkCountOut += len(extents)
+			self.highTS = max(self.highTS, highTS)
+			if self.setFileTime:
+				os.utime(self.outFileName(fn), (int(time.time()), self.highTS))
+			if digest:
+				self.manifestFiles.append(self.manifestEntry(fn, firstHeight, digest))
+			self.telemetry.bytesRead += written
+			self.telemetry.bytesWritten += written
+			print('Output file %s done, %i blocks written (of %i, %.1f%% complete)' %
+					(self.outFileName(fn), self.blkCountOut, len(self.blkindex), 100.0 * self.blkCountOut / len(self.blkindex)))
+			if self.checkpointFile:
+				self.writeCheckpoint()
+			self.telemetry.progress(self)
+		pool.close()
+		pool.join()
+
+		self.finishOutput()
+		print("Done (%i blocks written)" % (self.blkCountOut))
+
+def read_settings(filename):
+	'''Parse a key=value config file and fill in defaults'''
+	f = open(filename)
 	for line in f:
 		# skip comment lines
 		m = re.search('^\s*#', line)
@@ -277,23 +2074,150 @@ if __name__ == '__main__':
 		settings['max_out_sz'] = 1000L * 1000 * 1000
 	if 'out_of_order_cache_sz' not in settings:
 		settings['out_of_order_cache_sz'] = 100 * 1000 * 1000
+	if 'input_mmap' not in settings:
+		settings['input_mmap'] = 0
+	if 'extent_index' not in settings:
+		settings['extent_index'] = ''
+	if 'scan_workers' not in settings:
+		settings['scan_workers'] = 1
+	if 'copy_planner' not in settings:
+		settings['copy_planner'] = 0
+	if 'spill_dir' not in settings:
+		settings['spill_dir'] = ''
+	if 'range_copy' not in settings:
+		settings['range_copy'] = 0
+	if 'resume' not in settings:
+		settings['resume'] = 0
+	if 'output_index' not in settings:
+		settings['output_index'] = ''
+	if 'metrics_file' not in settings:
+		settings['metrics_file'] = ''
+	if 'metrics_interval' not in settings:
+		settings['metrics_interval'] = 10
+	if 'rpc_hashes' not in settings:
+		settings['rpc_hashes'] = 0
+	if 'host' not in settings:
+		settings['host'] = '127.0.0.1'
+	if 'port' not in settings:
+		settings['port'] = 8332
+	if 'max_height' not in settings:
+		settings['max_height'] = -1
+	if 'checkpoint' not in settings:
+		settings['checkpoint'] = ''
+	if 'checkpoint_interval' not in settings:
+		settings['checkpoint_interval'] = 10000
+	if 'hashlist_from_blocks' not in settings:
+		settings['hashlist_from_blocks'] = 0
+	if 'shard_workers' not in settings:
+		settings['shard_workers'] = 1
+	if 'manifest' not in settings:
+		settings['manifest'] = ''
+	if 'manifest_chunk_sz' not in settings:
+		settings['manifest_chunk_sz'] = 64 * 1000 * 1000
+	if 'stream_buffer_sz' not in settings:
+		settings['stream_buffer_sz'] = 64 * 1000 * 1000
+	if 'compress' not in settings:
+		settings['compress'] = ''
+	if 'compress_level' not in settings:
+		settings['compress_level'] = 6
+	if 'compress_chunk_sz' not in settings:
+		settings['compress_chunk_sz'] = 16 * 1000 * 1000
+	if 'compress_workers' not in settings:
+		settings['compress_workers'] = multiprocessing.cpu_count()
 
 	settings['max_out_sz'] = long(settings['max_out_sz'])
 	settings['split_timestamp'] = int(settings['split_timestamp'])
 	settings['file_timestamp'] = int(settings['file_timestamp'])
 	settings['netmagic'] = settings['netmagic'].decode('hex')
+	settings['input_dirs'] = [dirname.strip() for dirname in settings['input'].split(',')]
 	settings['out_of_order_cache_sz'] = int(settings['out_of_order_cache_sz'])
+	settings['input_mmap'] = int(settings['input_mmap'])
+	settings['scan_workers'] = int(settings['scan_workers'])
+	settings['copy_planner'] = int(settings['copy_planner'])
+	settings['range_copy'] = int(settings['range_copy'])
+	settings['resume'] = int(settings['resume'])
+	settings['metrics_interval'] = float(settings['metrics_interval'])
+	settings['rpc_hashes'] = int(settings['rpc_hashes'])
+	settings['port'] = int(settings['port'])
+	settings['max_height'] = int(settings['max_height'])
+	settings['checkpoint_interval'] = int(settings['checkpoint_interval'])
+	settings['hashlist_from_blocks'] = int(settings['hashlist_from_blocks'])
+	settings['shard_workers'] = int(settings['shard_workers'])
+	settings['manifest_chunk_sz'] = int(settings['manifest_chunk_sz'])
+	settings['stream_buffer_sz'] = int(settings['stream_buffer_sz'])
+	settings['compress_level'] = int(settings['compress_level'])
+	settings['compress_chunk_sz'] = int(settings['compress_chunk_sz'])
+	settings['compress_workers'] = int(settings['compress_workers'])
+	return settings
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: linearize-data.py CONFIG-FILE")
+		sys.exit(1)
 
-	if 'output_file' not in settings and 'output' not in settings:
-		print("Missing output file / directory")
+	read_settings(sys.argv[1])
+	if settings.get('output_stream') == '-':
+		reserve_stdout()
+
+	if 'output_file' not in settings and 'output' not in settings and 'output_stream' not in settings:
+		print("Missing output file / directory / stream")
 		sys.exit(1)
 
-	blkindex = get_block_hashes(settings)
-	blkmap = mkblockmap(blkindex)
+	if 'output_stream' in settings:
+		if 'output_file' in settings or 'output' in settings:
+			print("output_stream cannot be combined with output_file or output")
+			sys.exit(1)
+		if (settings['range_copy'] or settings['resume'] or settings['checkpoint'] or settings['output_index'] or
+				settings['compress'] or settings['split_timestamp'] or settings['file_timestamp']):
+			print("output_stream cannot be combined with range_copy, resume, checkpoint, output_index, " +
+					"compress, split_timestamp or file_timestamp")
+			sys.exit(1)
+
+	if settings['compress']:
+		if settings['compress'] not in ('zlib', 'lzma'):
+			print("Unknown compression %s (use zlib or lzma)" % settings['compress'])
+			sys.exit(1)
+		if settings['compress'] == 'lzma' and lzma is None:
+			print("lzma compression needs the lzma module")
+			sys.exit(1)
+		if 'output_file' not in settings:
+			print("Compressed output needs output_file")
+			sys.exit(1)
+		if settings['range_copy'] or settings['resume'] or settings['checkpoint'] or settings['output_index']:
+			print("Compressed output cannot be combined with range_copy, resume, checkpoint or output_index")
+			sys.exit(1)
+
+	if settings['shard_workers'] > 1 and ('output' not in settings or settings['split_timestamp']):
+		print("shard_workers needs an output directory, and cannot be combined with split_timestamp")
+		sys.exit(1)
 
-	if not "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f" in blkmap:
+	genesis = str_to_hash("000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f")
+	if settings['rpc_hashes']:
+		if 'rpcuser' not in settings or 'rpcpassword' not in settings:
+			print("Missing username and/or password in cfg file", file=sys.stderr)
+			sys.exit(1)
+		blkindex = RPCHashStream(settings)
+		blkindex.start()
+		blkmap = None
+		genesis_found = blkindex.available(0) > 0 and blkindex[0] == genesis
+	else:
+		if settings['hashlist_from_blocks']:
+			blkindex = get_best_chain_hashes(settings)
+		else:
+			blkindex = get_block_hashes(settings)
+		blkmap = mkblockmap(blkindex)
+		genesis_found = genesis in blkmap
+
+	if settings['rpc_hashes'] and blkindex.error:
+		print(blkindex.error, file=sys.stderr)
+		sys.exit(1)
+	if not genesis_found:
 		print("not found")
 	else:
 		BlockDataCopier(settings, blkindex, blkmap).run()
+		if settings['rpc_hashes'] and blkindex.error:
+			# the hashes stop short of the chain, and so does the output
+			print(blkindex.error, file=sys.stderr)
+			sys.exit(1)
 
 
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# linearize-decompress.py: Stream compressed linearize-data output back into bootstrap.dat form.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import struct
+import multiprocessing
+from collections import deque
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+
+def skip_blocks(data, count):
+	'''Return data without its first count block records'''
+	pos = 0
+	for i in range(count):
+		pos += 8 + struct.unpack_from('<I', data, pos + 4)[0]
+	return data[pos:]
+
+class StartChunk:
+	'''The first chunk when starting part way into it, decompressed up front'''
+	def __init__(self, data, skip):
+		self.data = skip_blocks(data, skip)
+
+	def get(self):
+		return self.data
+
+def decompress(fname, index, out, start_height, workers):
+	'''Write the blocks from start_height onwards to out, decompressing up to
+	   two chunks per worker ahead of the writer'''
+	first = index.find(start_height)
+	pool = multiprocessing.Pool(workers)
+	pending = deque()
+	with open(fname, "rb") as f:
+		for n in range(first, len(index)):
+			(height, blocks, offset, length, size) = index.chunks[n]
+			if len(pending) >= 2 * workers:
+				out.write(pending.popleft().get())
+			f.seek(offset)
+			job = (index.codec, f.read(length))
+			if n == first and height < start_height:
+				pending.append(StartChunk(linearize.decompress_chunk(job), start_height - height))
+			else:
+				pending.append(pool.apply_async(linearize.decompress_chunk, (job,)))
+	while pending:
+		out.write(pending.popleft().get())
+	pool.close()
+	pool.join()
+
+if __name__ == '__main__':
+	if len(sys.argv) not in (3, 4):
+		print("Usage: linearize-decompress.py COMPRESSED-FILE OUTPUT [START-HEIGHT]")
+		sys.exit(1)
+
+	fname = sys.argv[1]
+	index = linearize.ChunkIndex(fname + '.chunks')
+	if index.codec == 'lzma' and linearize.lzma is None:
+		print("lzma compressed output needs the lzma module", file=sys.stderr)
+		sys.exit(1)
+	start_height = 0
+	if len(sys.argv) == 4:
+		start_height = int(sys.argv[3])
+	if start_height >= index.blockCount():
+		print("%s only holds %i blocks" % (fname, index.blockCount()), file=sys.stderr)
+		sys.exit(1)
+
+	# OUTPUT may be a named pipe that bitcoind -loadblock is reading from
+	if sys.argv[2] == '-':
+		out = sys.stdout
+	else:
+		out = open(sys.argv[2], "wb")
+	decompress(fname, index, out, start_height, multiprocessing.cpu_count())
+	out.close()
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+#
+# linearize-headers.py: Extract block headers from linearized block data into columnar files.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# The archive is a directory holding headers.dat, the 80-byte headers in
+# height order, and one file per column with a fixed-width little-endian
+# value per height, so the record of height h is at h times the width.
+# Heights are the record positions.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import mmap
+import time
+import array
+import bisect
+import struct
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+reader = imp.load_source('linearize_reader',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-reader.py'))
+
+# Column name: array typecode of the 4-byte values
+COLUMNS = {
+	'version' : 'i',
+	'time' : 'I',
+	# running maximum of time, which unlike time never decreases
+	'maxtime' : 'I',
+	'bits' : 'I',
+	'nonce' : 'I',
+	'txcount' : 'I',
+}
+# Cumulative chain work is 16 bytes per height, in linearize.CHAINWORK form
+WORK_SZ = 16
+# Heights written between flushes
+FLUSH_BLOCKS = 10000
+
+class Column:
+	'''Read-only sequence over one mapped column file, usable with bisect'''
+	def __init__(self, data, typecode, count):
+		self.data = data
+		self.typecode = typecode
+		self.fmt = '<' + typecode
+		self.count = count
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, height):
+		if height < 0:
+			height += self.count
+		if height < 0 or height >= self.count:
+			raise IndexError(height)
+		return struct.unpack_from(self.fmt, self.data, height * 4)[0]
+
+	def slice(self, start, stop):
+		'''Values of heights start to stop-1 as an array, in one copy'''
+		result = array.array(self.typecode)
+		result.fromstring(self.data[start * 4:stop * 4])
+		if sys.byteorder == 'big':
+			result.byteswap()
+		return result
+
+class HeaderArchive:
+	'''Memory-mapped header archive directory'''
+	def __init__(self, dirname):
+		self.dirname = dirname
+		self.maps = []
+		self.headers = self.map('headers.dat')
+		self.count = len(self.headers) // 80
+		self.workData = self.map('work.dat')
+		self.count = min(self.count, len(self.workData) // WORK_SZ)
+		self.columns = {}
+		for name in COLUMNS:
+			data = self.map(name + '.dat')
+			self.count = min(self.count, len(data) // 4)
+			self.columns[name] = data
+		for name in COLUMNS:
+			self.columns[name] = Column(self.columns[name], COLUMNS[name], self.count)
+
+	def map(self, fname):
+		with open(os.path.join(self.dirname, fname), "rb") as f:
+			if os.fstat(f.fileno()).st_size == 0:
+				return ''
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.maps.append(data)
+		return data
+
+	def __len__(self):
+		return self.count
+
+	def column(self, name):
+		return self.columns[name]
+
+	def header(self, height):
+		if height < 0 or height >= self.count:
+			raise IndexError(height)
+		return self.headers[height * 80:(height + 1) * 80]
+
+	def hash(self, height):
+		return linearize.calc_hdr_hash(self.header(height))
+
+	def work(self, height):
+		'''Cumulative chain work up to and including height'''
+		if height < 0 or height >= self.count:
+			raise IndexError(height)
+		return linearize.unpack_work(self.workData, height)
+
+	def heightAtTime(self, timestamp):
+		'''First height whose block time, or that of a block before it, is
+		   at least timestamp; len(self) if there is none'''
+		return bisect.bisect_left(self.columns['maxtime'], timestamp)
+
+	def close(self):
+		for data in self.maps:
+			data.close()
+		self.maps = []
+
+def open_archive_files(dirname):
+	'''Open the archive files for appending, first truncating them all to the
+	   heights every file is complete for. Returns (files, height count).'''
+	widths = [('headers.dat', 80), ('work.dat', WORK_SZ)] + [(name + '.dat', 4) for name in sorted(COLUMNS)]
+	files = {}
+	count = None
+	for (fname, width) in widths:
+		path = os.path.join(dirname, fname)
+		if not os.path.exists(path):
+			open(path, "wb").close()
+		files[fname] = open(path, "r+b")
+		n = os.fstat(files[fname].fileno()).st_size // width
+		count = n if count is None else min(count, n)
+	for (fname, width) in widths:
+		files[fname].truncate(count * width)
+		files[fname].seek(0, os.SEEK_END)
+	return (files, count)
+
+def update_archive(settings):
+	'''Append the headers of the blocks not in the archive yet.
+	   Returns the number of heights added.'''
+	dirname = settings['headers_dir']
+	if not os.path.isdir(dirname):
+		os.makedirs(dirname)
+	(files, start) = open_archive_files(dirname)
+	prevHash = None
+	work = 0
+	maxTime = 0
+	if start:
+		archive = HeaderArchive(dirname)
+		prevHash = archive.hash(start - 1)
+		work = archive.work(start - 1)
+		maxTime = archive.column('maxtime')[start - 1]
+		archive.close()
+
+	columns = dict([(name, array.array(typecode)) for (name, typecode) in COLUMNS.items()])
+	headers = []
+	works = []
+	def flush():
+		files['headers.dat'].write(''.join(headers))
+		files['work.dat'].write(''.join(works))
+		for (name, values) in columns.items():
+			if sys.byteorder == 'big':
+				values.byteswap()
+			files[name + '.dat'].write(values.tostring())
+		del headers[:]
+		del works[:]
+		for name in COLUMNS:
+			columns[name] = array.array(COLUMNS[name])
+
+	added = 0
+	for block in reader.iter_heights(linearize.output_files(settings), settings['netmagic'], start):
+		header = block.header
+		(version, prev, merkleRoot, nTime, bits, nonce) = struct.unpack('<i32s32sIII', header)
+		if prevHash is not None and prev != prevHash:
+			raise ValueError("Block %i does not follow the archived block %i; the output was rewritten" %
+					(block.height, block.height - 1))
+		prevHash = linearize.calc_hdr_hash(header)
+		work += linearize.bits_to_work(bits)
+		maxTime = max(maxTime, nTime)
+		headers.append(header)
+		works.append(linearize.CHAINWORK.pack(work >> 64, work & 0xffffffffffffffffL))
+		columns['version'].append(version)
+		columns['time'].append(nTime)
+		columns['maxtime'].append(maxTime)
+		columns['bits'].append(bits)
+		columns['nonce'].append(nonce)
+		columns['txcount'].append(block.txCount)
+		added += 1
+		if len(headers) >= FLUSH_BLOCKS:
+			flush()
+	flush()
+	for f in files.values():
+		f.close()
+	return added
+
+if __name__ == '__main__':
+	if len(sys.argv) not in (2, 3):
+		print("Usage: linearize-headers.py CONFIG-FILE [TIMESTAMP]")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'headers_dir' not in settings:
+		settings['headers_dir'] = 'headers'
+
+	if len(sys.argv) == 3:
+		archive = HeaderArchive(settings['headers_dir'])
+		height = archive.heightAtTime(int(sys.argv[2]))
+		if height >= len(archive):
+			print("No block at or after %s" % sys.argv[2], file=sys.stderr)
+			sys.exit(1)
+		print("%i %s %s" % (height, linearize.hash_to_str(archive.hash(height)),
+				time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(archive.column('time')[height]))))
+		archive.close()
+		sys.exit(0)
+
+	if not linearize.output_files(settings):
+		print("No linearized output found")
+		sys.exit(1)
+	start = time.time()
+	try:
+		added = update_archive(settings)
+	except ValueError as e:
+		print("%s; remove %s to start over" % (e, settings['headers_dir']), file=sys.stderr)
+		sys.exit(1)
+	elapsed = max(time.time() - start, 1e-9)
+	archive = HeaderArchive(settings['headers_dir'])
+	print("Added %i headers in %.1f s (%.0f headers/s); %s holds heights 0 to %i" %
+			(added, elapsed, added / elapsed, settings['headers_dir'], len(archive) - 1))
+	archive.close()
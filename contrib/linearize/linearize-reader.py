@@ -0,0 +1,412 @@
+#!/usr/bin/python
+#
+# linearize-reader.py: Lazy block and transaction reader for block files and linearized output.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# Load it from other scripts with
+#   reader = imp.load_source('linearize_reader', 'linearize-reader.py')
+#
+# Files are memory-mapped, and Block, Tx, TxIn and TxOut objects only hold
+# the mapping and offsets into it. Fields are decoded when they are read.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import mmap
+import time
+import struct
+import hashlib
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+
+def dsha256(data):
+	return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def read_varint(data, pos):
+	'''Returns (value, position after the varint)'''
+	n = ord(data[pos])
+	if n < 0xfd:
+		return (n, pos + 1)
+	if n == 0xfd:
+		return (struct.unpack_from('<H', data, pos + 1)[0], pos + 3)
+	if n == 0xfe:
+		return (struct.unpack_from('<I', data, pos + 1)[0], pos + 5)
+	return (struct.unpack_from('<Q', data, pos + 1)[0], pos + 9)
+
+def write_varint(n):
+	if n < 0xfd:
+		return struct.pack('<B', n)
+	if n <= 0xffff:
+		return '\xfd' + struct.pack('<H', n)
+	if n <= 0xffffffff:
+		return '\xfe' + struct.pack('<I', n)
+	return '\xff' + struct.pack('<Q', n)
+
+def merkle_root(hashes):
+	'''Merkle root of a list of 32-byte hashes, which is left unchanged'''
+	hashes = list(hashes)
+	while len(hashes) > 1:
+		if len(hashes) % 2:
+			hashes.append(hashes[-1])
+		hashes = [dsha256(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2)]
+	return hashes[0]
+
+def skip_inputs(data, pos, count):
+	for i in range(count):
+		(scriptLen, pos) = read_varint(data, pos + 36)
+		pos += scriptLen + 4
+	return pos
+
+def skip_outputs(data, pos, count):
+	for i in range(count):
+		(scriptLen, pos) = read_varint(data, pos + 8)
+		pos += scriptLen
+	return pos
+
+# Output script forms, in the order of the kinds script_type returns
+SCRIPT_TYPES = ('p2pkh', 'p2sh', 'p2pk', 'multisig', 'nulldata', 'nonstandard')
+(P2PKH, P2SH, P2PK, MULTISIG, NULLDATA, NONSTANDARD) = range(len(SCRIPT_TYPES))
+
+def script_type(script):
+	'''(kind, data) for an output script, where data is the 20-byte hash of
+	   P2PKH and P2SH scripts, the public key of P2PK scripts, and None
+	   otherwise'''
+	n = len(script)
+	if n == 25 and script[:3] == '\x76\xa9\x14' and script[23:] == '\x88\xac':
+		return (P2PKH, script[3:23])
+	if n == 23 and script[:2] == '\xa9\x14' and script[22] == '\x87':
+		return (P2SH, script[2:22])
+	if (n == 35 and script[0] == '\x21' or n == 67 and script[0] == '\x41') and script[-1] == '\xac':
+		return (P2PK, script[1:-1])
+	if n >= 37 and '\x51' <= script[0] <= '\x60' and script[-1] == '\xae':
+		return (MULTISIG, None)
+	if n and script[0] == '\x6a':
+		return (NULLDATA, None)
+	return (NONSTANDARD, None)
+
+class TxIn(object):
+	'''Transaction input at offset of data'''
+	__slots__ = ('data', 'offset')
+
+	def __init__(self, data, offset):
+		self.data = data
+		self.offset = offset
+
+	@property
+	def prevHash(self):
+		return self.data[self.offset:self.offset + 32]
+
+	@property
+	def prevIndex(self):
+		return struct.unpack_from('<I', self.data, self.offset + 32)[0]
+
+	@property
+	def outpoint(self):
+		'''The 36-byte serialized outpoint spent'''
+		return self.data[self.offset:self.offset + 36]
+
+	@property
+	def script(self):
+		(scriptLen, pos) = read_varint(self.data, self.offset + 36)
+		return self.data[pos:pos + scriptLen]
+
+	@property
+	def sequence(self):
+		(scriptLen, pos) = read_varint(self.data, self.offset + 36)
+		return struct.unpack_from('<I', self.data, pos + scriptLen)[0]
+
+	def isCoinbase(self):
+		return self.prevIndex == 0xffffffff and self.prevHash == '\0' * 32
+
+class TxOut(object):
+	'''Transaction output at offset of data'''
+	__slots__ = ('data', 'offset')
+
+	def __init__(self, data, offset):
+		self.data = data
+		self.offset = offset
+
+	@property
+	def value(self):
+		return struct.unpack_from('<q', self.data, self.offset)[0]
+
+	@property
+	def script(self):
+		(scriptLen, pos) = read_varint(self.data, self.offset + 8)
+		return self.data[pos:pos + scriptLen]
+
+	@property
+	def raw(self):
+		'''The serialized value and script'''
+		(scriptLen, pos) = read_varint(self.data, self.offset + 8)
+		return self.data[self.offset:pos + scriptLen]
+
+class Tx(object):
+	'''Transaction of size bytes at offset of data'''
+	__slots__ = ('data', 'offset', 'size')
+
+	def __init__(self, data, offset, size):
+		self.data = data
+		self.offset = offset
+		self.size = size
+
+	@property
+	def raw(self):
+		return self.data[self.offset:self.offset + self.size]
+
+	@property
+	def txid(self):
+		'''Transaction hash, in the byte order of prevHash'''
+		return dsha256(linearize.view_slice(self.data, self.offset, self.size))
+
+	@property
+	def version(self):
+		return struct.unpack_from('<i', self.data, self.offset)[0]
+
+	@property
+	def lockTime(self):
+		return struct.unpack_from('<I', self.data, self.offset + self.size - 4)[0]
+
+	def inputs(self):
+		(count, pos) = read_varint(self.data, self.offset + 4)
+		result = []
+		for i in range(count):
+			result.append(TxIn(self.data, pos))
+			(scriptLen, pos) = read_varint(self.data, pos + 36)
+			pos += scriptLen + 4
+		return result
+
+	def outputs(self):
+		(count, pos) = read_varint(self.data, self.offset + 4)
+		pos = skip_inputs(self.data, pos, count)
+		(count, pos) = read_varint(self.data, pos)
+		result = []
+		for i in range(count):
+			result.append(TxOut(self.data, pos))
+			(scriptLen, pos) = read_varint(self.data, pos + 8)
+			pos += scriptLen
+		return result
+
+	def isCoinbase(self):
+		(count, pos) = read_varint(self.data, self.offset + 4)
+		return count == 1 and TxIn(self.data, pos).isCoinbase()
+
+class Block(object):
+	'''Block whose 80-byte header starts at offset of data, size bytes long
+	   including the header. height is None where it is not known.'''
+	__slots__ = ('data', 'offset', 'size', 'height')
+
+	def __init__(self, data, offset, size, height=None):
+		self.data = data
+		self.offset = offset
+		self.size = size
+		self.height = height
+
+	@property
+	def header(self):
+		return self.data[self.offset:self.offset + 80]
+
+	@property
+	def hash(self):
+		return linearize.calc_hdr_hash(linearize.view_slice(self.data, self.offset, 80))
+
+	@property
+	def version(self):
+		return struct.unpack_from('<i', self.data, self.offset)[0]
+
+	@property
+	def prevHash(self):
+		return self.data[self.offset + 4:self.offset + 36]
+
+	@property
+	def merkleRoot(self):
+		return self.data[self.offset + 36:self.offset + 68]
+
+	@property
+	def time(self):
+		return struct.unpack_from('<I', self.data, self.offset + 68)[0]
+
+	@property
+	def bits(self):
+		return struct.unpack_from('<I', self.data, self.offset + 72)[0]
+
+	@property
+	def nonce(self):
+		return struct.unpack_from('<I', self.data, self.offset + 76)[0]
+
+	@property
+	def txCount(self):
+		return read_varint(self.data, self.offset + 80)[0]
+
+	@property
+	def raw(self):
+		return self.data[self.offset:self.offset + self.size]
+
+	def txs(self):
+		'''Iterate over the transactions, finding where each one ends but
+		   decoding nothing else'''
+		data = self.data
+		(count, pos) = read_varint(data, self.offset + 80)
+		for i in range(count):
+			start = pos
+			(n, pos) = read_varint(data, pos + 4)
+			pos = skip_inputs(data, pos, n)
+			(n, pos) = read_varint(data, pos)
+			pos = skip_outputs(data, pos, n) + 4
+			yield Tx(data, start, pos - start)
+
+class MappedFiles:
+	'''Read-only memory maps of block files, kept open until close()'''
+	def __init__(self):
+		self.maps = {}
+
+	def get(self, fname):
+		if fname not in self.maps:
+			with open(fname, "rb") as f:
+				if os.fstat(f.fileno()).st_size == 0:
+					self.maps[fname] = ''
+				else:
+					self.maps[fname] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return self.maps[fname]
+
+	def close(self):
+		for data in self.maps.values():
+			if isinstance(data, mmap.mmap):
+				data.close()
+		self.maps = {}
+
+def file_blocks(data, netmagic, start=0):
+	'''Blocks in the mapped contents of one blkNNNNN.dat or bootstrap.dat file,
+	   in file order, from the record at offset start'''
+	pos = start
+	while pos + 8 <= len(data) and data[pos] != '\0':
+		if data[pos:pos + 4] != netmagic:
+			raise ValueError("invalid magic at offset %i" % pos)
+		size = struct.unpack_from('<I', data, pos + 4)[0]
+		if pos + 8 + size > len(data):
+			break # partially written record
+		yield Block(data, pos + 8, size)
+		pos += 8 + size
+
+def iter_files(fnames, netmagic, files=None):
+	'''Blocks of the given files in file order, without heights'''
+	files = files or MappedFiles()
+	for fname in fnames:
+		for block in file_blocks(files.get(fname), netmagic):
+			yield block
+
+def iter_heights(fnames, netmagic, start=0, stop=None, files=None):
+	'''Blocks of linearized output files (bootstrap.dat or an output
+	   directory's files, in order) with their heights, from start to stop-1'''
+	height = 0
+	for block in iter_files(fnames, netmagic, files):
+		if stop is not None and height >= stop:
+			break
+		if height >= start:
+			block.height = height
+			yield block
+		height += 1
+
+def iter_index(index_fname, output, start=0, stop=None, files=None):
+	'''Blocks from start to stop-1 located through an output index
+	   (see BlockIndexReader in linearize-data.py), without walking earlier ones'''
+	index = linearize.BlockIndexReader(index_fname, output)
+	files = files or MappedFiles()
+	if stop is None or stop > len(index):
+		stop = len(index)
+	try:
+		for height in range(start, stop):
+			(fn, offset, length) = index.extent(height)
+			yield Block(files.get(index.fileName(fn)), offset + 8, length - 8, height)
+	finally:
+		index.close()
+
+def iter_extents(extents, fileName, files=None):
+	'''Blocks at BlockExtents of input files, where fileName(fn) names the
+	   file of an extent, as BlockDataCopier.inFileName does'''
+	files = files or MappedFiles()
+	for extent in extents:
+		yield Block(files.get(fileName(extent.fn)), extent.offset - 80, extent.size + 80)
+
+def block_batches(fnames, netmagic, start, batchBytes, tip=None):
+	'''Split the blocks of linearized output files from height start onwards
+	   into jobs for a process pool. Yields (blocks, hex hash of the last one),
+	   where blocks lists (file name, header offset, size, height) of about
+	   batchBytes of block data. tip is the hex hash that the block at
+	   start - 1 must have, if something was already derived from it.'''
+	files = MappedFiles()
+	height = 0
+	batch = []
+	size = 0
+	for fname in fnames:
+		for block in file_blocks(files.get(fname), netmagic):
+			if height == start - 1 and tip is not None and linearize.hash_to_str(block.hash) != tip:
+				raise ValueError("Block %i is not the one processed before; the output was rewritten" % height)
+			if height >= start:
+				batch.append((fname, block.offset, block.size, height))
+				size += block.size
+				if size >= batchBytes:
+					yield (batch, linearize.hash_to_str(block.hash))
+					batch = []
+					size = 0
+			height += 1
+	if start > height:
+		raise ValueError("The output only holds %i blocks, %i were processed before" % (height, start))
+	if batch:
+		yield (batch, linearize.hash_to_str(block.hash))
+	files.close()
+
+def iter_txs(blocks):
+	'''(block, tx) for every transaction of the given blocks'''
+	for block in blocks:
+		for tx in block.txs():
+			yield (block, tx)
+
+def bench(fnames, netmagic):
+	'''Transactions per second for walking only, for decoding every field,
+	   and for also hashing each transaction'''
+	results = []
+	for mode in ('walk', 'fields', 'txid'):
+		files = MappedFiles()
+		start = time.time()
+		blocks = 0
+		txs = 0
+		for block in iter_files(fnames, netmagic, files):
+			blocks += 1
+			for tx in block.txs():
+				txs += 1
+				if mode == 'walk':
+					continue
+				for txin in tx.inputs():
+					txin.prevHash
+					txin.prevIndex
+					txin.script
+				for txout in tx.outputs():
+					txout.value
+					txout.script
+				if mode == 'txid':
+					tx.txid
+		elapsed = max(time.time() - start, 1e-9)
+		files.close()
+		results.append((mode, blocks, txs, elapsed))
+	return results
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: linearize-reader.py CONFIG-FILE")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	fnames = linearize.output_files(settings)
+	if not fnames:
+		print("No linearized output found")
+		sys.exit(1)
+	print("%-10s %10s %12s %10s %12s" % ('mode', 'blocks', 'txs', 'seconds', 'txs/s'))
+	for (mode, blocks, txs, elapsed) in bench(fnames, settings['netmagic']):
+		print("%-10s %10i %12i %10.2f %12.0f" % (mode, blocks, txs, elapsed, txs / elapsed))
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+#
+# linearize-stats.py: Per-block statistics (fees, size, counts, script types) from linearized block data.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# Output is a directory with one file per statistic, holding a fixed-width
+# little-endian value per height, as in linearize-headers.py.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import json
+import time
+import struct
+import multiprocessing
+from collections import deque
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+reader = imp.load_source('linearize_reader',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-reader.py'))
+
+# (column name, struct format of its values)
+COLUMNS = [
+	('fees', 'q'),
+	('size', 'I'),
+	('txcount', 'I'),
+	('inputs', 'I'),
+	('outputs', 'I'),
+] + [(name, 'I') for name in reader.SCRIPT_TYPES]
+# Bytes of block data handed to a worker at a time
+JOB_BYTES = 8 * 1000 * 1000
+# Created output in job results and the checkpointed UTXO map: outpoint, value
+COIN_RECORD = struct.Struct('<36sq')
+# Start of a checkpointed UTXO map: magic, height, hash of the block before it
+UTXO_HEADER = struct.Struct('<4sI32s')
+UTXO_MAGIC = 'LSU1'
+
+stats_files = None
+
+def stats_job(blocks):
+	'''Process pool entry point: for each block at (file name, header offset,
+	   size, height), return (height, hash, column values without the fee,
+	   value of the non-coinbase outputs, outpoints spent, outputs created).
+	   Outpoints are concatenated 36-byte strings, outputs COIN_RECORDs.'''
+	global stats_files
+	if stats_files is None:
+		stats_files = reader.MappedFiles()
+	results = []
+	for (fname, offset, size, height) in blocks:
+		block = reader.Block(stats_files.get(fname), offset, size, height)
+		txcount = 0
+		inputs = 0
+		outputs = 0
+		types = [0] * len(reader.SCRIPT_TYPES)
+		outValue = 0
+		spent = []
+		created = []
+		for tx in block.txs():
+			txcount += 1
+			coinbase = tx.isCoinbase()
+			if not coinbase:
+				for txin in tx.inputs():
+					spent.append(txin.outpoint)
+					inputs += 1
+			else:
+				inputs += 1
+			txid = tx.txid
+			for (n, txout) in enumerate(tx.outputs()):
+				outputs += 1
+				value = txout.value
+				kind = reader.script_type(txout.script)[0]
+				types[kind] += 1
+				if not coinbase:
+					outValue += value
+				# unspendable, and never in the UTXO set
+				if kind != reader.NULLDATA and height > 0:
+					created.append(COIN_RECORD.pack(txid + struct.pack('<I', n), value))
+		values = [size, txcount, inputs, outputs] + types
+		results.append((height, block.hash, values, outValue, ''.join(spent), ''.join(created)))
+	return results
+
+class StatsOutput:
+	'''The column files and checkpoint of the stats directory'''
+	def __init__(self, dirname):
+		self.dirname = dirname
+		self.checkpointFile = os.path.join(dirname, 'checkpoint.json')
+		self.files = {}
+		self.pending = dict([(name, []) for (name, fmt) in COLUMNS])
+
+	def resume(self):
+		'''Open the column files after the last checkpoint, truncating what was
+		   written since. Returns (height, hash of the block before it or None,
+		   UTXO map).'''
+		height = 0
+		tip = None
+		utxos = {}
+		if os.path.exists(self.checkpointFile):
+			with open(self.checkpointFile) as f:
+				checkpoint = json.load(f)
+			height = checkpoint['height']
+			tip = checkpoint['hash']
+			with open(os.path.join(self.dirname, checkpoint['utxo']), "rb") as f:
+				data = f.read()
+			(magic, utxoHeight, utxoTip) = UTXO_HEADER.unpack_from(data, 0)
+			if magic != UTXO_MAGIC or utxoHeight != height or linearize.hash_to_str(utxoTip) != tip:
+				raise ValueError("%s does not match the checkpoint at height %i" % (checkpoint['utxo'], height))
+			for pos in range(UTXO_HEADER.size, len(data), COIN_RECORD.size):
+				(outpoint, value) = COIN_RECORD.unpack_from(data, pos)
+				utxos[outpoint] = value
+			print("Resuming from checkpoint at height %i, %i unspent outputs" % (height, len(utxos)))
+		for (name, fmt) in COLUMNS:
+			path = os.path.join(self.dirname, name + '.dat')
+			if not os.path.exists(path):
+				open(path, "wb").close()
+			f = open(path, "r+b")
+			f.truncate(height * struct.calcsize('<' + fmt))
+			f.seek(0, os.SEEK_END)
+			self.files[name] = f
+		return (height, tip, utxos)
+
+	def append(self, values):
+		for ((name, fmt), value) in zip(COLUMNS, values):
+			self.pending[name].append(value)
+
+	def flush(self):
+		for (name, fmt) in COLUMNS:
+			values = self.pending[name]
+			self.files[name].write(struct.pack('<%i%s' % (len(values), fmt), *values))
+			self.pending[name] = []
+			self.files[name].flush()
+
+	def checkpoint(self, height, tip, utxos):
+		'''Make the columns durable up to height, then write the UTXO map to a
+		   file named after height, and last point the checkpoint at it. The
+		   map of the previous checkpoint is removed only after that.'''
+		self.flush()
+		for f in self.files.values():
+			os.fsync(f.fileno())
+		utxoName = "utxo-%i.dat" % height
+		utxoFile = os.path.join(self.dirname, utxoName)
+		with open(utxoFile + '.tmp', "wb") as f:
+			f.write(UTXO_HEADER.pack(UTXO_MAGIC, height, tip))
+			for (outpoint, value) in utxos.iteritems():
+				f.write(COIN_RECORD.pack(outpoint, value))
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(utxoFile + '.tmp', utxoFile)
+		tmpname = self.checkpointFile + '.tmp'
+		with open(tmpname, "w") as f:
+			json.dump({'height' : height, 'hash' : linearize.hash_to_str(tip), 'utxo' : utxoName}, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmpname, self.checkpointFile)
+		for fname in os.listdir(self.dirname):
+			if fname.startswith('utxo-') and fname != utxoName:
+				os.remove(os.path.join(self.dirname, fname))
+
+	def close(self):
+		for f in self.files.values():
+			f.close()
+		self.files = {}
+
+def load_stats(dirname):
+	'''Read the columns of a stats directory into a dict of name: tuple'''
+	columns = {}
+	for (name, fmt) in COLUMNS:
+		with open(os.path.join(dirname, name + '.dat'), "rb") as f:
+			data = f.read()
+		columns[name] = struct.unpack('<%i%s' % (len(data) // struct.calcsize('<' + fmt), fmt), data)
+	return columns
+
+def run_stats(settings):
+	'''Compute the statistics of the blocks after the last checkpoint. Blocks
+	   are parsed in a pool of processes, up to two jobs per process ahead;
+	   the UTXO map giving the fees is kept here and updated in height order.
+	   Returns the number of blocks processed.'''
+	fnames = linearize.output_files(settings)
+	if not os.path.isdir(settings['stats_dir']):
+		os.makedirs(settings['stats_dir'])
+	out = StatsOutput(settings['stats_dir'])
+	(height, tip, utxos) = out.resume()
+	interval = settings['stats_checkpoint_interval']
+	workers = settings['stats_workers']
+	pool = multiprocessing.Pool(workers)
+	pending = deque()
+	blocks = 0
+	lastReport = time.time()
+	start = time.time()
+	jobs = reader.block_batches(fnames, settings['netmagic'], height, JOB_BYTES, tip)
+	while True:
+		job = next(jobs, None)
+		if len(pending) >= 2 * workers or (job is None and pending):
+			for (h, hash, values, outValue, spent, created) in pending.popleft().get():
+				for pos in range(0, len(created), COIN_RECORD.size):
+					(outpoint, value) = COIN_RECORD.unpack_from(created, pos)
+					utxos[outpoint] = value
+				inValue = 0
+				for pos in range(0, len(spent), 36):
+					value = utxos.pop(spent[pos:pos + 36], None)
+					if value is None:
+						raise ValueError("Block %i spends missing output %s:%i" % (h,
+								linearize.hash_to_str(spent[pos:pos + 32]), struct.unpack_from('<I', spent, pos + 32)[0]))
+					inValue += value
+				out.append([inValue - outValue] + values)
+				height = h + 1
+				blocks += 1
+				if height % interval == 0:
+					out.checkpoint(height, hash, utxos)
+			out.flush()
+			now = time.time()
+			if now - lastReport >= 10:
+				print("Height %i: %i unspent outputs, %.0f blocks/s" % (height - 1, len(utxos), blocks / (now - start)))
+				lastReport = now
+		if job is not None:
+			pending.append(pool.apply_async(stats_job, (job[0],)))
+		elif not pending:
+			break
+	pool.close()
+	pool.join()
+	if blocks:
+		out.checkpoint(height, hash, utxos)
+	out.close()
+	return blocks
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: linearize-stats.py CONFIG-FILE")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'stats_dir' not in settings:
+		settings['stats_dir'] = 'stats'
+	if 'stats_workers' not in settings:
+		settings['stats_workers'] = multiprocessing.cpu_count()
+	if 'stats_checkpoint_interval' not in settings:
+		settings['stats_checkpoint_interval'] = 10000
+	settings['stats_workers'] = int(settings['stats_workers'])
+	settings['stats_checkpoint_interval'] = int(settings['stats_checkpoint_interval'])
+
+	if not linearize.output_files(settings):
+		print("No linearized output found")
+		sys.exit(1)
+	start = time.time()
+	try:
+		blocks = run_stats(settings)
+	except ValueError as e:
+		print("%s; remove %s to start over" % (e, settings['stats_dir']), file=sys.stderr)
+		sys.exit(1)
+	elapsed = max(time.time() - start, 1e-9)
+	print("Processed %i blocks in %.1f s (%.0f blocks/s)" % (blocks, elapsed, blocks / elapsed))
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+#
+# linearize-synth.py: Write synthetic blkNNNNN.dat files and a matching hashlist for benchmarks.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import heapq
+import itertools
+import random
+import struct
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+reader = imp.load_source('linearize_reader',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-reader.py'))
+
+# The main network genesis block, so that the generated chain passes the
+# genesis check of linearize-data.py
+GENESIS_BLOCK = (
+	'01000000' + '00' * 32 +
+	'3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a'
+	'29ab5f49ffff001d1dac2b7c'
+	'0101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff'
+	'4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72'
+	'206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff'
+	'0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f'
+	'61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000').decode('hex')
+
+COIN = 100000000
+# Unspent outputs kept available for new transactions to spend
+MAX_SPENDABLE = 100000
+NOISE_BITS = 20
+NOISE_SZ = 1 << NOISE_BITS
+
+class ChainSynthesizer:
+	'''Generates blocks of plausible transactions: a coinbase, then
+	   transactions spending earlier outputs into P2PKH and P2SH outputs.'''
+	def __init__(self, settings):
+		self.settings = settings
+		self.rng = random.Random(settings['synth_seed'])
+		self.spendable = [] # (txid, vout, value)
+		# Random bytes for scripts are cut from this buffer, which is much
+		# faster than generating them
+		self.noise = ('%0*x' % (2 * (NOISE_SZ + 256), self.rng.getrandbits(8 * (NOISE_SZ + 256)))).decode('hex')
+
+	def blockSize(self):
+		mean = self.settings['synth_block_sz']
+		dist = self.settings['synth_size_dist']
+		if dist == 'fixed':
+			size = mean
+		elif dist == 'uniform':
+			size = self.rng.randint(0, 2 * mean)
+		else: # exponential
+			size = int(self.rng.expovariate(1.0 / mean))
+		return max(size, 200)
+
+	def randbytes(self, n):
+		'''n (at most 256) pseudo-random bytes'''
+		pos = self.rng.getrandbits(NOISE_BITS)
+		return self.noise[pos:pos + n]
+
+	def outputScript(self):
+		if self.rng.random() < 0.7:
+			return '\x76\xa9\x14' + self.randbytes(20) + '\x88\xac' # P2PKH
+		return '\xa9\x14' + self.randbytes(20) + '\x87' # P2SH
+
+	def serializeTx(self, inputs, outputs):
+		tx = [struct.pack('<i', 1), reader.write_varint(len(inputs))]
+		for (prevout, script) in inputs:
+			tx.append(prevout + reader.write_varint(len(script)) + script + '\xff\xff\xff\xff')
+		tx.append(reader.write_varint(len(outputs)))
+		for (value, script) in outputs:
+			tx.append(struct.pack('<q', value) + reader.write_varint(len(script)) + script)
+		tx.append(struct.pack('<I', 0))
+		return ''.join(tx)
+
+	def spendTx(self):
+		'''A transaction spending one or two earlier outputs, and its fee'''
+		inputs = []
+		total = 0
+		for i in range(min(len(self.spendable), 1 + (self.rng.random() < 0.5))):
+			j = int(self.rng.random() * len(self.spendable))
+			self.spendable[j], self.spendable[-1] = self.spendable[-1], self.spendable[j]
+			(txid, vout, value) = self.spendable.pop()
+			# a signature and a compressed public key
+			inputs.append((txid + struct.pack('<I', vout), '\x48' + self.randbytes(72) + '\x21' + self.randbytes(33)))
+			total += value
+		fee = min(total // 100, self.rng.randint(1000, 50000))
+		outputs = []
+		remaining = total - fee
+		for i in range(1 + int(self.rng.random() * 3)):
+			value = remaining if i == 2 else int(self.rng.random() * remaining)
+			outputs.append((value, self.outputScript()))
+			remaining -= value
+		outputs[-1] = (outputs[-1][0] + remaining, outputs[-1][1])
+		return (self.serializeTx(inputs, outputs), outputs, fee)
+
+	def block(self, prev, height, nTime, stale=False):
+		'''Serialize a block (header and transactions) on top of prev. The
+		   outputs a stale block spends and creates are not used later.'''
+		if stale:
+			spendable = list(self.spendable)
+		target = self.blockSize()
+		txs = []
+		txOutputs = []
+		fees = 0
+		size = 80 + 200
+		while size < target and self.spendable:
+			(tx, outputs, fee) = self.spendTx()
+			txs.append(tx)
+			txOutputs.append(outputs)
+			fees += fee
+			size += len(tx)
+		coinbaseScript = reader.write_varint(4) + struct.pack('<I', height) + self.randbytes(4)
+		coinbase = self.serializeTx([('\0' * 32 + '\xff\xff\xff\xff', coinbaseScript)],
+				[(50 * COIN + fees, self.outputScript())])
+		txs.insert(0, coinbase)
+		txOutputs.insert(0, [(50 * COIN + fees, None)])
+
+		txids = [reader.dsha256(tx) for tx in txs]
+		for (txid, outputs) in zip(txids, txOutputs):
+			for (vout, (value, script)) in enumerate(outputs):
+				if value > 0 and len(self.spendable) < MAX_SPENDABLE:
+					self.spendable.append((txid, vout, value))
+
+		if stale:
+			self.spendable = spendable
+		blk_hdr = (struct.pack('<i', 2) + prev + reader.merkle_root(txids) +
+				struct.pack('<III', nTime, 0x1d00ffff, self.rng.getrandbits(32)))
+		return blk_hdr + reader.write_varint(len(txs)) + ''.join(txs)
+
+class BlockFileWriter:
+	'''Appends block records to blkNNNNN.dat files of up to maxSize bytes'''
+	def __init__(self, dirname, netmagic, maxSize):
+		self.dirname = dirname
+		self.netmagic = netmagic
+		self.maxSize = maxSize
+		self.fn = 0
+		self.f = None
+		self.size = 0
+		self.count = 0
+
+	def write(self, block):
+		if self.f and self.size + 8 + len(block) > self.maxSize:
+			self.f.close()
+			self.f = None
+			self.fn += 1
+		if not self.f:
+			self.f = open(os.path.join(self.dirname, "blk%05d.dat" % self.fn), "wb")
+			self.size = 0
+		self.f.write(self.netmagic + struct.pack('<I', len(block)) + block)
+		self.size += 8 + len(block)
+		self.count += 1
+
+	def close(self):
+		if self.f:
+			self.f.close()
+			self.f = None
+
+def synthesize(settings):
+	'''Write synth_blocks main chain blocks to the input directory, together
+	   with fork and orphan blocks, in an order where a synth_out_of_order
+	   fraction of blocks is delayed by up to synth_reorder_window positions.
+	   Returns the main chain hashes.'''
+	synth = ChainSynthesizer(settings)
+	rng = random.Random(settings['synth_seed'] + 1)
+	writer = BlockFileWriter(settings['input'], settings['netmagic'], settings['synth_file_sz'])
+	window = settings['synth_reorder_window']
+	pending = [] # heap of (position, sequence, block)
+	sequence = itertools.count()
+
+	def emit(block, height):
+		position = height
+		if window and rng.random() < settings['synth_out_of_order']:
+			position += rng.randint(1, window)
+		heapq.heappush(pending, (position, next(sequence), block))
+
+	hashes = []
+	nTime = 1231006505
+	prev = None
+	forks = 0
+	orphans = 0
+	for height in range(settings['synth_blocks']):
+		if height == 0:
+			block = GENESIS_BLOCK
+		else:
+			nTime += 600
+			block = synth.block(prev, height, nTime)
+		hashes.append(linearize.calc_hdr_hash(block[:80]))
+
+		if 0 < height < settings['synth_blocks'] - 3 and rng.random() < settings['synth_fork_rate']:
+			# a stale branch of one to three blocks, next to this block,
+			# always overtaken by the main chain
+			forkPrev = prev
+			for i in range(rng.randint(1, 3)):
+				fork = synth.block(forkPrev, height + i, nTime + i * 600 + 1, stale=True)
+				forkPrev = linearize.calc_hdr_hash(fork[:80])
+				emit(fork, height + i)
+				forks += 1
+		if height > 0 and rng.random() < settings['synth_orphan_rate']:
+			emit(synth.block(synth.randbytes(32), height, nTime, stale=True), height)
+			orphans += 1
+
+		emit(block, height)
+		# blocks only move later, so nothing still to come can be placed at or before height
+		while pending and pending[0][0] <= height:
+			writer.write(heapq.heappop(pending)[2])
+		prev = hashes[-1]
+		if (height + 1) % 10000 == 0:
+			print("%i blocks generated" % (height + 1))
+
+	while pending:
+		writer.write(heapq.heappop(pending)[2])
+	writer.close()
+	print("Wrote %i blocks (%i main chain, %i fork, %i orphan) to %i files in %s" %
+			(writer.count, len(hashes), forks, orphans, writer.fn + 1, settings['input']))
+	return hashes
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: linearize-synth.py CONFIG-FILE")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'synth_blocks' not in settings:
+		settings['synth_blocks'] = 10000
+	if 'synth_block_sz' not in settings:
+		settings['synth_block_sz'] = 100000
+	if 'synth_size_dist' not in settings:
+		settings['synth_size_dist'] = 'exponential'
+	if 'synth_out_of_order' not in settings:
+		settings['synth_out_of_order'] = 0.05
+	if 'synth_reorder_window' not in settings:
+		settings['synth_reorder_window'] = 500
+	if 'synth_fork_rate' not in settings:
+		settings['synth_fork_rate'] = 0.01
+	if 'synth_orphan_rate' not in settings:
+		settings['synth_orphan_rate'] = 0.001
+	if 'synth_file_sz' not in settings:
+		settings['synth_file_sz'] = 128 * 1024 * 1024
+	if 'synth_seed' not in settings:
+		settings['synth_seed'] = 1
+	settings['synth_blocks'] = int(settings['synth_blocks'])
+	settings['synth_block_sz'] = int(settings['synth_block_sz'])
+	settings['synth_out_of_order'] = float(settings['synth_out_of_order'])
+	settings['synth_reorder_window'] = int(settings['synth_reorder_window'])
+	settings['synth_fork_rate'] = float(settings['synth_fork_rate'])
+	settings['synth_orphan_rate'] = float(settings['synth_orphan_rate'])
+	settings['synth_file_sz'] = int(settings['synth_file_sz'])
+	settings['synth_seed'] = int(settings['synth_seed'])
+	if settings['synth_size_dist'] not in ('fixed', 'uniform', 'exponential'):
+		print("Unknown synth_size_dist %s (use fixed, uniform or exponential)" % settings['synth_size_dist'])
+		sys.exit(1)
+
+	if not os.path.isdir(settings['input']):
+		os.makedirs(settings['input'])
+	if os.path.exists(os.path.join(settings['input'], "blk00000.dat")):
+		print("%s already contains block files" % settings['input'])
+		sys.exit(1)
+
+	hashes = synthesize(settings)
+	with open(settings['hashlist'], "w") as f:
+		for hash in hashes:
+			f.write(linearize.hash_to_str(hash) + '\n')
+	print("Wrote %i hashes to %s" % (len(hashes), settings['hashlist']))
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+#
+# linearize-txindex.py: Build a txid index over blkNNNNN.dat files and look up raw transactions.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import mmap
+import time
+import heapq
+import struct
+import itertools
+import multiprocessing
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+reader = imp.load_source('linearize_reader',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-reader.py'))
+
+# Sorted runs merged at once; more are first merged in groups of this many
+MERGE_FANIN = 256
+# Records read or written at a time
+RECORD_BATCH = 20000
+
+class TxIndex:
+	'''Sorted table of fixed-width records, one per transaction found in the
+	   indexed files, searched through a memory map.
+
+	   The header lists the indexed files with their size and mtime when
+	   they were scanned and the offset scanning stopped at, as in
+	   ExtentIndex, so that an update only scans what was appended since.
+	   A transaction in several blocks (forks, or the duplicate coinbases
+	   before BIP30) has a record for each.'''
+	MAGIC = 'LTX1'
+	FILE_HDR = struct.Struct('<QdQ') # size, mtime, end
+	# txid, file number, offset of the block header, offset of the
+	# transaction from the block header, transaction length
+	RECORD = struct.Struct('<32sIQII')
+
+	def __init__(self, fname):
+		self.fname = fname
+		self.files = [] # (path, size, mtime, end), by file number
+		self.dataStart = len(self.MAGIC) + 4
+		self.count = 0
+		self.data = None
+		self.inputs = {}
+		if not os.path.exists(fname):
+			return
+		with open(fname, "rb") as f:
+			if f.read(4) != self.MAGIC:
+				raise ValueError("%s is not a transaction index" % fname)
+			nfiles = struct.unpack('<I', f.read(4))[0]
+			for i in range(nfiles):
+				path = f.read(struct.unpack('<H', f.read(2))[0])
+				self.files.append((path,) + self.FILE_HDR.unpack(f.read(self.FILE_HDR.size)))
+			self.dataStart = f.tell()
+			self.count = (os.fstat(f.fileno()).st_size - self.dataStart) // self.RECORD.size
+			if self.count:
+				self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __len__(self):
+		return self.count
+
+	@classmethod
+	def header(cls, files):
+		hdr = [cls.MAGIC, struct.pack('<I', len(files))]
+		for (path, size, mtime, end) in files:
+			hdr.append(struct.pack('<H', len(path)) + path + cls.FILE_HDR.pack(size, mtime, end))
+		return ''.join(hdr)
+
+	def record(self, i):
+		return self.RECORD.unpack_from(self.data, self.dataStart + i * self.RECORD.size)
+
+	def find(self, txid):
+		'''Position of the first record whose txid is not below txid'''
+		lo = 0
+		hi = self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			pos = self.dataStart + mid * self.RECORD.size
+			if self.data[pos:pos + 32] < txid:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def locations(self, txid):
+		'''(file name, block offset, offset in block, length) for every copy
+		   of the transaction'''
+		result = []
+		i = self.find(txid)
+		while i < self.count:
+			(found, fn, blockOffset, txOffset, length) = self.record(i)
+			if found != txid:
+				break
+			result.append((self.files[fn][0], blockOffset, txOffset, length))
+			i += 1
+		return result
+
+	def getRawTransaction(self, txid):
+		'''The serialized transaction, or None if it is not indexed'''
+		locations = self.locations(txid)
+		if not locations:
+			return None
+		(fname, blockOffset, txOffset, length) = locations[0]
+		if fname not in self.inputs:
+			self.inputs[fname] = open(fname, "rb")
+		f = self.inputs[fname]
+		f.seek(blockOffset + txOffset)
+		return f.read(length)
+
+	def records(self, skip=()):
+		'''Iterate over the packed records, leaving out those of the file
+		   numbers in skip'''
+		size = self.RECORD.size
+		for first in range(0, self.count, RECORD_BATCH):
+			n = min(RECORD_BATCH, self.count - first)
+			pos = self.dataStart + first * size
+			batch = self.data[pos:pos + n * size]
+			for i in range(0, n * size, size):
+				record = batch[i:i + size]
+				if skip and struct.unpack_from('<I', record, 32)[0] in skip:
+					continue
+				yield record
+
+	def close(self):
+		if self.data is not None:
+			self.data.close()
+			self.data = None
+		for f in self.inputs.values():
+			f.close()
+		self.inputs = {}
+
+def index_file_job(job):
+	'''Process pool entry point: write the sorted records of the transactions
+	   in one input file from offset start to runFname.
+	   Returns (fn, runFname, offset scanning stopped at, transaction count).'''
+	(fn, fname, netmagic, start, runFname) = job
+	files = reader.MappedFiles()
+	records = []
+	end = start
+	for block in reader.file_blocks(files.get(fname), netmagic, start):
+		for tx in block.txs():
+			records.append(TxIndex.RECORD.pack(tx.txid, fn, block.offset, tx.offset - block.offset, tx.size))
+		end = block.offset + block.size
+	files.close()
+	records.sort()
+	with open(runFname, "wb") as f:
+		f.write(''.join(records))
+	return (fn, runFname, end, len(records))
+
+def run_records(fname):
+	'''Iterate over the packed records of a sorted run file'''
+	size = TxIndex.RECORD.size
+	with open(fname, "rb") as f:
+		while True:
+			batch = f.read(RECORD_BATCH * size)
+			if not batch:
+				break
+			for i in range(0, len(batch), size):
+				yield batch[i:i + size]
+
+def merge_records(sources, f):
+	'''Write the merged records of sorted sources to f'''
+	batch = []
+	for record in heapq.merge(*sources):
+		batch.append(record)
+		if len(batch) >= RECORD_BATCH:
+			f.write(''.join(batch))
+			batch = []
+	f.write(''.join(batch))
+
+def merge_runs(runs):
+	'''Merge sorted run files in groups until at most MERGE_FANIN remain, so
+	   that the final merge does not hold too many files open'''
+	level = 0
+	while len(runs) > MERGE_FANIN:
+		merged = []
+		for i in range(0, len(runs), MERGE_FANIN):
+			group = runs[i:i + MERGE_FANIN]
+			fname = "%s.m%i" % (group[0], level)
+			with open(fname, "wb") as f:
+				merge_records([run_records(run) for run in group], f)
+			for run in group:
+				os.remove(run)
+			merged.append(fname)
+		runs = merged
+		level += 1
+	return runs
+
+def update_index(settings):
+	'''Index the input files not indexed yet and what was appended to the
+	   others, then merge the new records into the table.
+	   Returns the number of transactions added.'''
+	fname = settings['txindex']
+	index = TxIndex(fname)
+	files = list(index.files)
+	fileNumbers = dict([(path, fn) for (fn, (path, size, mtime, end)) in enumerate(files)])
+	skip = set()
+	jobs = []
+	stats = {}
+	for path in itertools.chain(*linearize.input_dir_files(settings)):
+		st = os.stat(path)
+		fn = fileNumbers.get(path)
+		if fn is None:
+			fn = len(files)
+			files.append((path, 0, 0, 0))
+			start = 0
+		else:
+			(path, size, mtime, end) = files[fn]
+			if size == st.st_size and mtime == st.st_mtime:
+				continue
+			if st.st_size >= size:
+				start = end
+			else:
+				# a replaced file: drop its records and scan it again
+				skip.add(fn)
+				start = 0
+		stats[fn] = st
+		jobs.append((fn, path, settings['netmagic'], start, "%s.run%05d" % (fname, fn)))
+	if not jobs:
+		index.close()
+		return 0
+
+	workers = min(settings['txindex_workers'], len(jobs))
+	print("Indexing %i input files with %i processes" % (len(jobs), workers))
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+		results = pool.imap_unordered(index_file_job, jobs)
+	else:
+		pool = None
+		results = itertools.imap(index_file_job, jobs)
+	runs = []
+	added = 0
+	for (fn, runFname, end, count) in results:
+		st = stats[fn]
+		files[fn] = (files[fn][0], st.st_size, st.st_mtime, end)
+		runs.append(runFname)
+		added += count
+	if pool:
+		pool.close()
+		pool.join()
+
+	runs = merge_runs(sorted(runs))
+	tmpname = fname + '.tmp'
+	with open(tmpname, "wb") as f:
+		f.write(TxIndex.header(files))
+		merge_records([index.records(skip)] + [run_records(run) for run in runs], f)
+	index.close()
+	for run in runs:
+		os.remove(run)
+	os.rename(tmpname, fname)
+	return added
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print("Usage: linearize-txindex.py CONFIG-FILE [TXID...]")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'txindex' not in settings:
+		settings['txindex'] = 'txindex.dat'
+	if 'txindex_workers' not in settings:
+		settings['txindex_workers'] = multiprocessing.cpu_count()
+	settings['txindex_workers'] = int(settings['txindex_workers'])
+
+	if len(sys.argv) > 2:
+		index = TxIndex(settings['txindex'])
+		missing = 0
+		for txid in sys.argv[2:]:
+			tx = index.getRawTransaction(linearize.str_to_hash(txid))
+			if tx is None:
+				print("%s not found" % txid, file=sys.stderr)
+				missing += 1
+			else:
+				print(tx.encode('hex'))
+		index.close()
+		sys.exit(1 if missing else 0)
+
+	start = time.time()
+	added = update_index(settings)
+	elapsed = max(time.time() - start, 1e-9)
+	index = TxIndex(settings['txindex'])
+	print("Added %i transactions in %.1f s (%.0f tx/s); %s holds %i transactions from %i files" %
+			(added, elapsed, added / elapsed, settings['txindex'], len(index), len(index.files)))
+	index.close()
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+#
+# linearize-utxo.py: Rebuild the unspent transaction output set from linearized block data.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import time
+import struct
+import resource
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+reader = imp.load_source('linearize_reader',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-reader.py'))
+
+COIN = 100000000
+
+def compress_script(script):
+	'''P2PKH and P2SH scripts as a type byte and the 20-byte hash, anything
+	   else as its length + 2 and the script'''
+	(kind, hash) = reader.script_type(script)
+	if kind == reader.P2PKH:
+		return '\x00' + hash
+	if kind == reader.P2SH:
+		return '\x01' + hash
+	return reader.write_varint(len(script) + 2) + script
+
+def decompress_script(data, pos):
+	'''Returns (script, position after it)'''
+	if data[pos] == '\x00':
+		return ('\x76\xa9\x14' + data[pos + 1:pos + 21] + '\x88\xac', pos + 21)
+	if data[pos] == '\x01':
+		return ('\xa9\x14' + data[pos + 1:pos + 21] + '\x87', pos + 21)
+	(n, pos) = reader.read_varint(data, pos)
+	return (data[pos:pos + n - 2], pos + n - 2)
+
+def pack_coin(height, coinbase, amount, script):
+	return reader.write_varint(height * 2 + coinbase) + reader.write_varint(amount) + compress_script(script)
+
+def unpack_coin(data):
+	'''Returns (height, coinbase, amount, script)'''
+	(code, pos) = reader.read_varint(data, 0)
+	(amount, pos) = reader.read_varint(data, pos)
+	return (code >> 1, code & 1, amount, decompress_script(data, pos)[0])
+
+def coin_amount(data):
+	(code, pos) = reader.read_varint(data, 0)
+	return reader.read_varint(data, pos)[0]
+
+def current_rss():
+	'''Resident memory in kB not backed by files, so that the mapped block
+	   files do not count, or peak RSS where /proc is not available'''
+	try:
+		with open('/proc/self/statm') as f:
+			fields = f.read().split()
+		return (int(fields[1]) - int(fields[2])) * resource.getpagesize() // 1024
+	except IOError:
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class UtxoSet:
+	'''Unspent outputs keyed by the 36-byte serialized outpoint (txid and
+	   output index), with the creating height, coinbase flag, amount and
+	   compressed script packed into one string per output. As in bitcoind,
+	   the genesis coinbase and OP_RETURN outputs are never added.'''
+	def __init__(self):
+		self.coins = {}
+		self.totalAmount = 0
+		self.height = -1
+		self.bestBlock = None
+
+	def __len__(self):
+		return len(self.coins)
+
+	def connectBlock(self, block):
+		'''Spend the inputs and add the outputs of the block at height
+		   self.height + 1. Returns the total fees paid in the block.'''
+		height = self.height + 1
+		coins = self.coins
+		fees = 0
+		for tx in block.txs():
+			coinbase = tx.isCoinbase()
+			txid = tx.txid
+			if not coinbase:
+				for txin in tx.inputs():
+					coin = coins.pop(txin.outpoint, None)
+					if coin is None:
+						raise ValueError("Block %i spends missing output %s:%i" %
+								(height, linearize.hash_to_str(txin.prevHash), txin.prevIndex))
+					amount = coin_amount(coin)
+					fees += amount
+					self.totalAmount -= amount
+			if height == 0:
+				continue
+			for (n, txout) in enumerate(tx.outputs()):
+				value = txout.value
+				script = txout.script
+				if not coinbase:
+					fees -= value
+				if script[:1] == '\x6a': # OP_RETURN
+					continue
+				outpoint = txid + struct.pack('<I', n)
+				old = coins.get(outpoint)
+				if old is not None:
+					# Duplicate coinbase (before BIP30): the new one replaces it
+					self.totalAmount -= coin_amount(old)
+				coins[outpoint] = pack_coin(height, coinbase, value, script)
+				self.totalAmount += value
+		self.height = height
+		self.bestBlock = block.hash
+		return fees
+
+	def stats(self):
+		'''Totals in the form gettxoutsetinfo reports them. Transactions with
+		   unspent outputs are counted in one pass over the sorted outpoints,
+		   which keeps the outputs of a transaction together.'''
+		transactions = 0
+		txid = None
+		for outpoint in sorted(self.coins):
+			if txid is None or not outpoint.startswith(txid):
+				txid = outpoint[:32]
+				transactions += 1
+		return {
+			'height' : self.height,
+			'bestblock' : linearize.hash_to_str(self.bestBlock) if self.bestBlock else None,
+			'transactions' : transactions,
+			'txouts' : len(self.coins),
+			'total_amount' : self.totalAmount,
+		}
+
+	def writeSnapshot(self, fname):
+		'''Write the outputs sorted by outpoint, each as the outpoint, the
+		   length of the packed coin and the packed coin'''
+		tmpname = fname + '.tmp'
+		with open(tmpname, "wb") as f:
+			for outpoint in sorted(self.coins):
+				coin = self.coins[outpoint]
+				f.write(outpoint + reader.write_varint(len(coin)) + coin)
+		os.rename(tmpname, fname)
+
+def read_snapshot(fname):
+	'''Iterate over (outpoint, height, coinbase, amount, script) in a snapshot'''
+	with open(fname, "rb") as f:
+		data = f.read()
+	pos = 0
+	while pos < len(data):
+		outpoint = data[pos:pos + 36]
+		(n, pos) = reader.read_varint(data, pos + 36)
+		yield (outpoint,) + unpack_coin(data[pos:pos + n])
+		pos += n
+
+def compare_with_node(settings, stats):
+	'''Check the totals against gettxoutsetinfo. Returns False on a mismatch.'''
+	linearize_hashes = imp.load_source('linearize_hashes',
+		os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-hashes.py'))
+	rpc = linearize_hashes.BitcoinRPC(settings['host'], settings['port'],
+			settings['rpcuser'], settings['rpcpassword'])
+	reply = rpc.execute(rpc.build_request(0, 'gettxoutsetinfo', None))
+	if rpc.response_is_error(reply):
+		print("JSON-RPC: gettxoutsetinfo failed: %s" % reply['error'], file=sys.stderr)
+		return False
+	node = reply['result']
+	if node['bestblock'] != stats['bestblock']:
+		print("Node tip is %s at height %i, replay ended at %s at height %i; not comparable" %
+				(node['bestblock'], node['height'], stats['bestblock'], stats['height']))
+		return False
+	ok = True
+	node['total_amount'] = int(round(node['total_amount'] * COIN))
+	for key in ('height', 'transactions', 'txouts', 'total_amount'):
+		match = node[key] == stats[key]
+		ok = ok and match
+		print("%-14s replay %-20s node %-20s %s" % (key, stats[key], node[key], "ok" if match else "MISMATCH"))
+	return ok
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: linearize-utxo.py CONFIG-FILE")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'utxo_snapshot_heights' not in settings:
+		settings['utxo_snapshot_heights'] = ''
+	if 'utxo_snapshot_dir' not in settings:
+		settings['utxo_snapshot_dir'] = '.'
+	if 'utxo_check_rpc' not in settings:
+		settings['utxo_check_rpc'] = 0
+	settings['utxo_check_rpc'] = int(settings['utxo_check_rpc'])
+	snapshots = set([int(h) for h in settings['utxo_snapshot_heights'].split(',') if h.strip()])
+	if settings['utxo_check_rpc'] and ('rpcuser' not in settings or 'rpcpassword' not in settings):
+		print("Missing username and/or password in cfg file", file=sys.stderr)
+		sys.exit(1)
+
+	fnames = linearize.output_files(settings)
+	if not fnames:
+		print("No linearized output found")
+		sys.exit(1)
+	stop = None
+	if settings['max_height'] >= 0:
+		stop = settings['max_height'] + 1
+
+	utxos = UtxoSet()
+	baseRss = current_rss()
+	start = time.time()
+	lastReport = start
+	for block in reader.iter_heights(fnames, settings['netmagic'], 0, stop):
+		utxos.connectBlock(block)
+		if block.height in snapshots:
+			fname = os.path.join(settings['utxo_snapshot_dir'], "utxo-%i.dat" % block.height)
+			utxos.writeSnapshot(fname)
+			print("Height %i: %i unspent outputs, %.8f BTC, snapshot written to %s" %
+					(block.height, len(utxos), utxos.totalAmount / COIN, fname))
+		now = time.time()
+		if now - lastReport >= 10:
+			print("Height %i: %i unspent outputs, %.0f blocks/s, %.0f bytes per output" %
+					(block.height, len(utxos), (block.height + 1) / (now - start),
+					 (current_rss() - baseRss) * 1024 / max(len(utxos), 1)))
+			lastReport = now
+
+	elapsed = max(time.time() - start, 1e-9)
+	stats = utxos.stats()
+	print("Replayed %i blocks in %.1f s (%.0f blocks/s)" % (utxos.height + 1, elapsed, (utxos.height + 1) / elapsed))
+	print("%i unspent outputs in %i transactions, %.8f BTC" %
+			(stats['txouts'], stats['transactions'], stats['total_amount'] / COIN))
+	print("Memory: %i kB, %.0f bytes per unspent output" %
+			(current_rss() - baseRss, (current_rss() - baseRss) * 1024 / max(len(utxos), 1)))
+	if settings['utxo_check_rpc'] and not compare_with_node(settings, stats):
+		sys.exit(1)
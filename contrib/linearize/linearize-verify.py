@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+# linearize-verify.py: Check the chain linkage and merkle roots of linearized block data.
+#
+# Copyright (c) 2013-2014 The Bitcoin developers
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+from __future__ import print_function, division
+import os
+import sys
+import imp
+import struct
+import multiprocessing
+
+linearize = imp.load_source('linearize_data',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-data.py'))
+reader = imp.load_source('linearize_reader',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-reader.py'))
+
+# Number of blocks handed to a worker at a time
+BLOCKS_PER_JOB = 1000
+
+def tx_end(data, pos):
+	'''Return the offset just past the transaction starting at pos'''
+	pos += 4 # version
+	(n_in, pos) = reader.read_varint(data, pos)
+	for i in range(n_in):
+		pos += 36 # prevout
+		(script_len, pos) = reader.read_varint(data, pos)
+		pos += script_len + 4 # script, sequence
+	(n_out, pos) = reader.read_varint(data, pos)
+	for i in range(n_out):
+		pos += 8 # value
+		(script_len, pos) = reader.read_varint(data, pos)
+		pos += script_len
+	return pos + 4 # lock time
+
+def block_merkle_root(rawblock):
+	'''Compute the merkle root of the transactions in a block body (without header).
+	   Raises ValueError if the transactions do not exactly fill the body.'''
+	(n_tx, pos) = reader.read_varint(rawblock, 0)
+	txids = []
+	for i in range(n_tx):
+		end = tx_end(rawblock, pos)
+		if end > len(rawblock):
+			raise ValueError("transaction %i runs past the end of the block" % i)
+		txids.append(reader.dsha256(rawblock[pos:end]))
+		pos = end
+	if pos != len(rawblock) or not txids:
+		raise ValueError("block size does not match its transactions")
+	return reader.merkle_root(txids)
+
+def verify_merkle_job(job):
+	'''Process pool entry point: check the merkle roots of a run of blocks
+	   in one file. Returns (height, reason) for the first bad block, or None.'''
+	(fname, blocks) = job
+	with open(fname, "rb") as f:
+		for (height, offset, size, root) in blocks:
+			f.seek(offset)
+			rawblock = f.read(size)
+			try:
+				if block_merkle_root(rawblock) != root:
+					return (height, "merkle root mismatch")
+			except (ValueError, IndexError, struct.error) as e:
+				return (height, "unparseable transactions: %s" % e)
+	return None
+
+def scan_headers(fnames, netmagic, blkindex):
+	'''Walk the headers of all blocks in order, checking that each links to the
+	   previous one. Returns (jobs, count, failure), where jobs are the merkle
+	   checks to run and failure is (height, reason) for a broken link, or None.'''
+	jobs = []
+	height = 0
+	prev = '\0' * 32
+	for fname in fnames:
+		job = []
+		with open(fname, "rb") as f:
+			fsize = os.fstat(f.fileno()).st_size
+			pos = 0
+			while True:
+				inhdr = f.read(8)
+				if len(inhdr) < 8 or inhdr[0] == "\0":
+					break
+				if inhdr[:4] != netmagic:
+					return (jobs, height, (height, "invalid magic in %s at offset %i" % (fname, pos)))
+				size = struct.unpack("<I", inhdr[4:])[0] - 80
+				blk_hdr = f.read(80)
+				if len(blk_hdr) < 80 or pos + 88 + size > fsize:
+					return (jobs, height, (height, "truncated block in %s at offset %i" % (fname, pos)))
+				if blk_hdr[4:36] != prev:
+					return (jobs, height, (height, "previous block hash does not match block %i" % (height - 1)))
+				prev = linearize.calc_hdr_hash(blk_hdr)
+				if blkindex is not None and (height >= len(blkindex) or blkindex[height] != prev):
+					return (jobs, height, (height, "block hash is not in the hashlist at this height"))
+
+				job.append((height, pos + 88, size, blk_hdr[36:68]))
+				if len(job) >= BLOCKS_PER_JOB:
+					jobs.append((fname, job))
+					job = []
+				f.seek(size, os.SEEK_CUR)
+				pos += 88 + size
+				height += 1
+		if job:
+			jobs.append((fname, job))
+	return (jobs, height, None)
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: linearize-verify.py CONFIG-FILE")
+		sys.exit(1)
+
+	settings = linearize.read_settings(sys.argv[1])
+	if 'output_file' not in settings and 'output' not in settings:
+		print("Missing output file / directory")
+		sys.exit(1)
+	if 'verify_workers' not in settings:
+		settings['verify_workers'] = multiprocessing.cpu_count()
+	settings['verify_workers'] = int(settings['verify_workers'])
+
+	blkindex = None
+	if os.path.exists(settings['hashlist']):
+		blkindex = linearize.get_block_hashes(settings)
+
+	fnames = linearize.output_files(settings)
+	(jobs, count, failure) = scan_headers(fnames, settings['netmagic'], blkindex)
+	print("Checked chain linkage of %i blocks in %i files" % (count, len(fnames)))
+
+	# Stop merkle checks at a broken link, and report the first failure overall
+	if failure is not None:
+		jobs = [(fname, [b for b in blocks if b[0] < failure[0]]) for (fname, blocks) in jobs]
+	pool = multiprocessing.Pool(max(1, settings['verify_workers']))
+	for result in pool.imap_unordered(verify_merkle_job, jobs):
+		if result is not None and (failure is None or result[0] < failure[0]):
+			failure = result
+	pool.close()
+	pool.join()
+
+	if failure is not None:
+		print("First bad height: %i (%s)" % failure)
+		sys.exit(1)
+	print("OK: %i blocks verified" % count)
+